@@ -0,0 +1,1036 @@
+# benchmarks for the starboard cog. runs it against a fake discord (no gateway, no token) and a throwaway database.
+#   python bench.py commit            events/sec with a commit per event vs group commit
+#   python bench.py race              concurrent stars and unstars on messages right at the minimum. checks that every
+#                                     message ends up awarded exactly when it should, and awarded only once
+#   python bench.py plans             EXPLAIN QUERY PLAN for every query in the cog on a db with a million stars. checks
+#                                     that none of them scan a table or sort more than a handful of rows. the *top
+#                                     ones again on a db with only one guild
+#   python bench.py random            awards and unawards messages, then checks that *random picks them uniformly
+#   python bench.py reads             latency of *info, *top and *random while stars are being written nonstop, with
+#                                     reads on the writer connection vs on the read pool
+#   python bench.py pack              db size and star/unstar/*info times before and after packing the stars of
+#                                     messages past the timeout
+#   python bench.py dump              *export then *importdump into an empty db, checked row for row. peak memory of
+#                                     the export for a small and a big server, which should be about the same
+#   python bench.py shards            processes with a shard each (no gateway, made up events) all writing to one db,
+#                                     and one of them changing every guild's config. checks the stars are all there
+#                                     and that the others heard about the config. then some more get awarded while
+#                                     discord takes longer than busy_timeout, which a lock held across a call would fail
+#   python bench.py memory            RSS and events/s of discord.py itself (caches, parsing, dispatch) under a made up
+#                                     gateway of busy servers, with PROFILE=full and PROFILE=lean (see main.py)
+#   python bench.py replay            streams of raw events (a viral message, many guilds, a purge) through the
+#                                     listeners, against a discord with latency and rate limits. reports events/s,
+#                                     handler latency, and sql statements and discord calls per event. --save keeps the
+#                                     results, --against compares with saved ones and fails on regressions
+import discord
+import aiosqlite
+import argparse
+import asyncio
+import contextlib
+import datetime
+import gc
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from typing import Callable
+
+import database
+import ipc
+import main as asteroid
+import starboard
+
+STAR = discord.PartialEmoji(name="⭐")
+GUILD = 1000
+SB = 2000  # starboard channel
+CHANNEL = 3000  # where the starred messages are
+
+ids = itertools.count(discord.utils.time_snowflake(discord.utils.utcnow()))  # fresh snowflakes, so on_time holds
+
+### FAKE DISCORD
+# only as much of discord.py as the cog touches. every call to discord goes through `FakeBot.call`, which counts it and
+#   waits `latency` seconds. with `limit=(n, per)`, each kind of call gets n per `per` seconds in each channel, like
+#   discord's per-route buckets. going over is a 429, and the call waits for the bucket to reset and tries again, which
+#   is what discord.py does by itself
+
+class FakeUser:
+    def __init__(self, id:int) -> None:
+        self.id = id
+        self.display_name = f"user{id}"
+        self.display_avatar = discord.Object(id)
+        self.display_avatar.url = f"https://cdn.example/{id}.png"
+
+class FakeMessage:
+    def __init__(self, bot:"FakeBot", channel_id:int, id:int, author_id:int, content:str="hi") -> None:
+        self.bot, self.id = bot, id
+        self.channel = bot.get_partial_messageable(channel_id)
+        self.author = FakeUser(author_id)
+        self.system_content = self.content = content
+        self.attachments, self.stickers, self.reactions = [], [], []
+        self.poll = self.reference = self.edited_at = None
+        self.flags = discord.MessageFlags()
+        self.created_at = discord.utils.snowflake_time(id)
+        self.jump_url = f"https://discord.com/channels/{GUILD}/{channel_id}/{id}"
+
+class FakePartialMessage:
+    def __init__(self, bot:"FakeBot", channel_id:int, id:int) -> None:
+        self.bot, self.channel_id, self.id = bot, channel_id, id
+
+    async def fetch(self) -> FakeMessage:
+        await self.bot.call("fetch", self.channel_id)
+        if (msg := self.bot.messages.get(self.id)) is None: raise discord.NotFound(FakeResponse(404), "gone")
+        return msg
+
+    async def edit(self, **_) -> None:
+        await self.bot.call("edit", self.channel_id)
+        if self.id not in self.bot.messages: raise discord.NotFound(FakeResponse(404), "gone")
+
+    async def delete(self) -> None:
+        await self.bot.call("delete", self.channel_id)
+        if self.bot.messages.pop(self.id, None) is None: raise discord.NotFound(FakeResponse(404), "gone")
+
+    async def remove_reaction(self, emoji, member) -> None:
+        await self.bot.call("remove_reaction", self.channel_id)
+
+class FakeChannel:  # stands in for both channels and partial messageables
+    def __init__(self, bot:"FakeBot", id:int, name:str) -> None:
+        self.bot, self.id, self.name = bot, id, name
+
+    def get_partial_message(self, id:int) -> FakePartialMessage:
+        return FakePartialMessage(self.bot, self.id, id)
+
+    async def delete_messages(self, messages) -> None:
+        await self.bot.call("delete_messages", self.id)
+        for msg in messages: self.bot.messages.pop(msg.id, None)
+
+    async def send(self, **_) -> FakeMessage:
+        await self.bot.call("send", self.id)
+        msg = FakeMessage(self.bot, self.id, next(ids), 1)
+        self.bot.messages[msg.id] = msg
+        return msg
+
+class FakeResponse:  # what discord.HTTPException wants
+    def __init__(self, status:int) -> None:
+        self.status, self.reason = status, "fake"
+
+class FakeTree:
+    def add_command(self, *_, **__) -> None: pass
+
+class FakeAttachment:  # kept on disk, so it doesn't count as memory the bot uses
+    def __init__(self, path:str) -> None:
+        self.path, self.filename = path, os.path.basename(path)
+        self.size = os.path.getsize(path)
+
+    async def read(self) -> bytes:
+        with open(self.path, "rb") as f: return f.read()
+
+class FakeContext:  # for calling commands directly. keeps what it's sent, files in `uploads` (a directory)
+    def __init__(self, bot:"FakeBot", attachments:list[FakeAttachment]=[], uploads:str|None=None) -> None:
+        self.bot, self.guild, self.uploads = bot, discord.Object(GUILD), uploads
+        self.guild.filesize_limit = discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+        self.message = discord.Object(next(ids))
+        self.message.attachments = attachments
+        self.sent: list[str|None] = []
+        self.files: list[FakeAttachment] = []
+
+    async def send(self, content:str|None=None, *, file:discord.File|None=None, **__) -> None:
+        await self.bot.call("send", CHANNEL)
+        self.sent.append(content)
+        if file is not None and self.uploads is not None:
+            with open(path := os.path.join(self.uploads, file.filename), "wb") as f: shutil.copyfileobj(file.fp, f)
+            self.files.append(FakeAttachment(path))
+
+    def typing(self) -> contextlib.AbstractAsyncContextManager:
+        return contextlib.nullcontext()
+
+class FakeBot:
+    def __init__(self, db:aiosqlite.Connection, reader:database.ReadPool, latency:float=0.0,
+                 limit:tuple[int,float]|None=None) -> None:
+        self.db, self.reader, self.latency, self.limit = db, reader, latency, limit
+        self.tree = FakeTree()
+        self.calls = Counter()
+        self.buckets: dict[tuple[str,int], list] = {}  # (call, channel) -> [remaining, reset]
+        self.channels = {SB: FakeChannel(self, SB, "starboard"), CHANNEL: FakeChannel(self, CHANNEL, "general")}
+        self.messages: dict[int, FakeMessage] = {}
+        self.cog: starboard.Starboard|None = None
+        self.peers = ipc.Peers(None)
+        self.dispatched: set[asyncio.Task] = set()
+
+    async def call(self, name:str, channel_id:int=0) -> None:
+        self.calls[name] += 1
+        while self.limit is not None:
+            n, per = self.limit
+            bucket = self.buckets.setdefault((name, channel_id), [n, 0.0])
+            if (now := time.perf_counter()) >= bucket[1]: bucket[:] = n, now+per
+            if bucket[0] > 0:
+                bucket[0] -= 1
+                break
+            self.calls["429"] += 1
+            await asyncio.sleep(self.latency + bucket[1]-now)
+        await asyncio.sleep(self.latency)
+
+    def get_channel(self, id:int) -> FakeChannel|None:
+        return self.channels.get(id)
+
+    def get_partial_messageable(self, id:int) -> FakeChannel:
+        return self.channels.get(id) or FakeChannel(self, id, "")
+
+    def get_guild(self, id:int) -> None:
+        return None
+
+    def dispatch(self, event:str, *args) -> None:  # only to the cog, which is the only one listening anyway
+        if (listener := getattr(self.cog, "on_"+event, None)) is not None:
+            self.dispatched.add(task := asyncio.create_task(listener(*args)))
+            task.add_done_callback(self.dispatched.discard)
+
+    async def add_cog(self, cog:starboard.Starboard) -> None:
+        await cog.cog_load()
+        self.cog = cog
+
+    async def close(self) -> None:
+        await self.cog.cog_unload()
+        await self.db.close()
+
+    def post(self, author_id:int, channel_id:int=CHANNEL) -> FakeMessage:  # a message "sent" by someone
+        msg = FakeMessage(self, channel_id, next(ids), author_id)
+        self.messages[msg.id] = msg
+        return msg
+
+def reaction(event_type:str, msg:FakeMessage, user_id:int, guild_id:int=GUILD) -> discord.RawReactionActionEvent:
+    return discord.RawReactionActionEvent(
+        {"message_id":msg.id, "channel_id":msg.channel.id, "user_id":user_id, "guild_id":guild_id,
+         "message_author_id":msg.author.id, "type":0},
+        STAR, event_type)
+
+def bulk_delete(msgs:list[FakeMessage], guild_id:int=GUILD) -> discord.RawBulkMessageDeleteEvent:
+    return discord.RawBulkMessageDeleteEvent(
+        {"ids":[str(msg.id) for msg in msgs], "channel_id":msgs[0].channel.id, "guild_id":guild_id})
+
+async def make_bot(path:str, minimum:int=3, latency:float=0.0, committer=starboard.GroupCommit,
+                   reader=database.ReadPool, limit:tuple[int,float]|None=None) -> FakeBot:
+    db = await database.connect(path, autocommit=False)
+    bot = FakeBot(db, reader(path), latency, limit)
+    if isinstance(bot.reader, SharedReader): bot.reader.db = db
+    await starboard.setup(bot)
+    await db.execute("INSERT INTO guilds(guild,sb,minimum) VALUES(?,?,?)", (GUILD, SB, minimum))
+    await db.commit()
+    await bot.cog.cog_load()
+    bot.cog.committer = committer(db)
+    return bot
+
+### BENCHMARKS
+
+class CommitEach(starboard.GroupCommit):  # what we did before group commit, a commit per write
+    async def commit(self) -> None:
+        self.stats["waited"] += 1
+        async with self.lock:
+            await self.db.commit()
+        self.stats["commits"] += 1
+
+# `users` people star `messages` messages at once, all reactions in flight together like in a reaction storm
+async def storm(bot:FakeBot, messages:int, users:int) -> float:
+    posts = [bot.post(author_id=1) for _ in range(messages)]
+    events = [reaction("REACTION_ADD", msg, 10+user) for msg in posts for user in range(users)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*map(bot.cog.on_raw_reaction_add, events), return_exceptions=True)
+    rate = len(events) / (time.perf_counter() - start)
+    if errors := Counter(repr(x) for x in results if isinstance(x, Exception)):
+        print(f"{sum(errors.values())} handlers failed: {errors.most_common(3)}")
+    return rate
+
+async def bench_commit(args) -> None:
+    for name, committer in [("commit per event", CommitEach), ("group commit", starboard.GroupCommit)]:
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            bot = await make_bot(os.path.join(tmp, "bench.db"), args.minimum, args.latency, committer)
+            rate = await storm(bot, args.messages, args.users)
+            stats = bot.cog.committer.stats
+            print(f"{name:>18}: {rate:8.0f} events/s, {stats['commits']} commits for {stats['waited']} writes")
+            await bot.close()
+
+# every message starts at minimum-1 stars, then gets a burst of stars and unstars all at once, shuffled between messages
+#   but in order for each message. same-message events are serialized by the cog, so the result has to be consistent
+async def bench_race(args) -> None:
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        bot = await make_bot(os.path.join(tmp, "bench.db"), args.minimum, args.latency)
+        posts = [bot.post(author_id=1) for _ in range(args.messages)]
+        await asyncio.gather(*(bot.cog.on_raw_reaction_add(reaction("REACTION_ADD", msg, 10+user))
+                               for msg in posts for user in range(args.minimum-1)))
+        per_msg = []
+        for msg in posts:
+            events, users = [], list(range(100, 100+args.users))
+            for user in users: events.append(reaction("REACTION_ADD", msg, user))
+            for user in random.sample(users, random.randrange(len(users)+1)):
+                events.append(reaction("REACTION_REMOVE", msg, user))
+            per_msg.append(events)
+        # interleave the messages, keeping each message's own events in order
+        events = [ev for batch in itertools.zip_longest(*per_msg) for ev in batch if ev is not None]
+        handler = {"REACTION_ADD":bot.cog.on_raw_reaction_add, "REACTION_REMOVE":bot.cog.on_raw_reaction_remove}
+        start = time.perf_counter()
+        results = await asyncio.gather(*(handler[ev.event_type](ev) for ev in events), return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        await bot.cog.edits.drain()
+
+        problems = [repr(x) for x in results if isinstance(x, Exception)]
+        awarded = {msg for msg, in await bot.db.execute_fetchall("SELECT msg FROM awarded")}
+        for msg in posts:
+            count = await bot.cog.star_count(msg.id)
+            real, = await (await bot.db.execute("SELECT count(*) FROM stars WHERE msg=?", (msg.id,))).fetchone()
+            if count != real: problems.append(f"{msg.id}: counts says {count}, stars has {real}")
+            if (count >= args.minimum) != (msg.id in awarded):
+                problems.append(f"{msg.id}: {count} stars but {'' if msg.id in awarded else 'not '}awarded")
+        posted = sum(m.channel.id == SB for m in bot.messages.values())
+        if posted != len(awarded): problems.append(f"{posted} starboard messages for {len(awarded)} awarded")
+        print(f"{len(events)} events in {elapsed:.2f}s ({len(events)/elapsed:.0f}/s), {len(awarded)} awarded, "
+              f"{bot.calls['send']} sends, {bot.calls['delete']} deletes, {len(bot.cog.locks.locks)} locks left")
+        print("\n".join(problems) or "all consistent")
+        await bot.close()
+        if problems: sys.exit(1)
+
+# every query the cog makes that reads rows, with parameters in the seeded db. the second value is what the plan can
+#   have besides searches: "sort" if a temp b-tree is fine (it only sorts what the search found), "scan" if it reads
+#   everything anyway
+QUERIES = [
+    ("guilds (cog_load)",      "SELECT guild,minimum,sb,timeout FROM guilds", (), "scan"),
+    ("load_guild",             "SELECT minimum,sb,timeout FROM guilds WHERE guild=?", (GUILD,), ""),
+    ("load_tracked size",      "SELECT (SELECT count(*) FROM counts) + 2*(SELECT count(*) FROM awarded)", (), "scan"),
+    ("load_tracked",           "SELECT msg FROM counts UNION ALL SELECT msg FROM awarded "
+                               "UNION ALL SELECT msg_sb FROM awarded", (), "scan"),
+    ("star_count",             "SELECT count FROM counts WHERE msg=?", ("msg",), ""),
+    ("add_star count",         "SELECT count,starrers,mediums FROM counts LEFT JOIN packed USING(msg) "
+                               "WHERE counts.msg=?",
+                               ("msg",), ""),
+    ("unpack_star",            "SELECT starrers,mediums FROM packed WHERE msg=?", ("msg",), ""),
+    ("export awarded",         "SELECT msg,msg_sb,msg_ch,guild,author FROM awarded WHERE guild=?", (GUILD,), ""),
+    ("export stars",           "SELECT starrer,msg,stars.guild,medium FROM counts CROSS JOIN stars USING(msg) "
+                               "WHERE counts.guild=?1 AND stars.guild=?1", (GUILD,), ""),
+    ("export packed",          "SELECT msg,packed.guild,starrers,mediums FROM counts CROSS JOIN packed USING(msg) "
+                               "WHERE counts.guild=?1 AND packed.guild=?1", (GUILD,), ""),
+    ("reconcile watermarks",   "SELECT guild,seen FROM watermarks", (), "scan"),
+    ("reconcile expected",     "SELECT msg, sum(medium=?), sum(medium=?) FROM stars WHERE msg IN "
+                               "(SELECT msg FROM counts WHERE guild=?3 AND msg>=?4 UNION ALL "
+                               "SELECT msg FROM awarded WHERE guild=?3 AND msg_sb>=?4) GROUP BY msg",
+                               (0, 1, GUILD, "msg"), ""),
+    ("reconcile originals",    "SELECT msg_sb,msg FROM awarded WHERE guild=? AND msg_sb>=?", (GUILD, "msg_sb"), ""),
+    ("reconcile_msg packed",   "SELECT 1 FROM packed WHERE msg=?", ("msg",), ""),
+    ("reconcile_msg awarded",  "SELECT msg_ch,author FROM awarded WHERE msg=?", ("msg",), ""),
+    ("reconcile_msg stars",    "SELECT starrer,medium FROM stars WHERE msg=?", ("msg",), ""),
+    ("importdump elsewhere",   "SELECT msg FROM counts WHERE msg IN (?2,?3) AND guild!=?1 UNION ALL "
+                               "SELECT msg FROM awarded WHERE msg IN (?2,?3) AND guild!=?1 UNION ALL "
+                               "SELECT msg FROM packed WHERE msg IN (?2,?3) AND guild!=?1", (GUILD,"msg","msg"), ""),
+    ("importdump packed",      "SELECT msg FROM packed WHERE msg IN (?,?,?)", ("msg","msg","msg"), ""),
+    ("pack_timed_out",         "SELECT msg FROM counts WHERE guild=? AND msg<? "
+                               "AND EXISTS(SELECT 1 FROM stars WHERE stars.msg=counts.msg)", (GUILD,"msg"), ""),
+    ("forget_message",         "DELETE FROM stars WHERE msg=?", ("msg",), ""),
+    ("unaward",                "SELECT msg_sb,guild FROM awarded WHERE msg=?", ("msg",), ""),
+    ("unaward delete",         "DELETE FROM awarded WHERE msg=?", ("msg",), ""),
+    ("find_msg",               "SELECT msg,msg_ch,author FROM awarded WHERE msg_sb=?", ("msg_sb",), ""),
+    ("awarded?",               "SELECT msg_sb FROM awarded WHERE msg=?", ("msg",), ""),
+    ("remove_star",            "DELETE FROM stars WHERE starrer=? AND msg=? AND medium=?", (10,"msg",0), ""),
+    ("remove_star medium",     "SELECT medium FROM stars WHERE starrer=? AND msg=?", (10,"msg"), ""),
+    ("bulk delete stars",      "DELETE FROM stars WHERE msg IN (?,?,?)", ("msg","msg","msg"), ""),
+    ("bulk delete awarded",    "SELECT msg_sb FROM awarded WHERE msg IN (?,?,?)", ("msg","msg","msg"), ""),
+    ("*info",                  "SELECT coalesce(sum(count),0),count(*),(SELECT coalesce(sum(n),0) FROM sizes "
+                               "WHERE guild=?1 AND author=0) FROM counts WHERE guild=?1", (GUILD,), ""),
+    ("*top",                   "SELECT msg_ch,msg FROM counts JOIN awarded USING(msg) WHERE counts.guild=? AND "
+                               "+counts.msg>=? ORDER BY count DESC, msg DESC LIMIT ? OFFSET ?", (GUILD,0,10,0), ""),
+    ("*top by user",           "SELECT msg_ch,msg FROM counts JOIN awarded USING(msg) WHERE counts.guild=? AND "
+                               "+counts.msg>=? AND awarded.guild=counts.guild AND author=? "
+                               "ORDER BY count DESC, msg DESC LIMIT ? OFFSET ?",
+                               (GUILD,0,1,10,0), "sort"),
+    ("*random size",           "SELECT n FROM sizes WHERE guild=? AND author=?", (GUILD,0), ""),
+    ("*random",                "SELECT msg,msg_ch,coalesce(count,0) FROM awarded LEFT JOIN counts USING(msg) "
+                               "WHERE awarded.guild=? AND ord=?", (GUILD,0), ""),
+    ("*random by user",        "SELECT msg,msg_ch,coalesce(count,0) FROM awarded LEFT JOIN counts USING(msg) "
+                               "WHERE awarded.guild=? AND author=? AND author_ord=?", (GUILD,1,0), ""),
+]
+
+# `stars` stars spread over `guilds` guilds, about 5 a message, and a fifth of the messages awarded
+async def seed(db:aiosqlite.Connection, stars:int, guilds:int) -> None:
+    msgs = stars // 5
+    await db.executemany("INSERT OR IGNORE INTO guilds(guild,sb) VALUES(?,?)", ((GUILD+g, SB+g) for g in range(guilds)))
+    await db.executemany("INSERT OR IGNORE INTO stars(starrer,msg,guild,medium) VALUES(?,?,?,?)",
+                         ((random.randrange(10, 10000), m, GUILD+m%guilds, random.randrange(3))
+                          for m in random.choices(range(1<<40, (1<<40)+msgs), k=stars)))
+    await db.executemany("INSERT INTO awarded(msg,msg_sb,msg_ch,guild,author) VALUES(?,?,?,?,?)",
+                         ((m, (2<<40)+m, CHANNEL, GUILD+m%guilds, random.randrange(1,1000))
+                          for m in range(1<<40, (1<<40)+msgs, 5)))
+    await db.commit()
+    await db.execute("ANALYZE")
+
+# queries that are also checked on a db with only one guild. after ANALYZE, guild=? looks like it picks every row
+#   there, and the planner may go for another index (and a sort) instead
+ONE_GUILD = ("*top", "*top by user")
+
+async def bench_plans(args) -> None:
+    problems = []
+    for guilds, queries in (args.guilds, QUERIES), (1, [q for q in QUERIES if q[0] in ONE_GUILD]):
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            await plans(os.path.join(tmp, "bench.db"), args.stars, guilds, queries, problems)
+    print("\n".join(problems) or "all good")
+    if problems: sys.exit(1)
+
+async def plans(path:str, stars:int, guilds:int, queries:list, problems:list[str]) -> None:
+    db = await database.connect(path)
+    await database.migrate(db, starboard.MIGRATIONS)
+    start = time.perf_counter()
+    await seed(db, stars, guilds)
+    print(f"seeded {stars} stars in {guilds} guilds in {time.perf_counter()-start:.1f}s")
+    msg, msg_sb = await (await db.execute("SELECT msg,msg_sb FROM awarded LIMIT 1")).fetchone()
+    for name, sql, params, allowed in queries:
+        params = [{"msg":msg, "msg_sb":msg_sb}.get(x, x) for x in params]
+        plan = [row[-1] for row in await db.execute_fetchall("EXPLAIN QUERY PLAN "+sql, params)]
+        start = time.perf_counter()
+        await db.execute_fetchall(sql, params)
+        elapsed = time.perf_counter() - start
+        await db.rollback()  # the deletes
+        print(f"{name:>22} {elapsed*1000:8.2f}ms  " + "; ".join(plan))
+        for step in plan:
+            if (step.startswith("SCAN") and allowed != "scan"
+                or "TEMP B-TREE" in step and allowed not in ("sort","scan")):
+                problems.append(f"{name} ({guilds} guilds): {step}")
+    await db.close()
+
+# chi-square value that a uniform sample goes over with probability 0.001 (Wilson-Hilferty, fine for df>=5 or so)
+def chi2_critical(df:int, z:float=3.09) -> float:
+    return df * (1 - 2/(9*df) + z*(2/(9*df))**0.5)**3
+
+async def bench_random(args) -> None:
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        bot = await make_bot(os.path.join(tmp, "bench.db"))
+        award = "INSERT INTO awarded(msg,msg_sb,msg_ch,guild,author) VALUES(?,?,?,?,?)"
+        msgs = {next(ids): random.randrange(1, 4) for _ in range(args.messages)}  # msg -> author
+        await bot.db.executemany(award, ((m, next(ids), CHANNEL, GUILD, a) for m, a in msgs.items()))
+        # unaward a third of them one by one (each moves the last message into the hole), then award some more
+        for m in random.sample(sorted(msgs), len(msgs)//3):
+            await bot.db.execute("DELETE FROM awarded WHERE msg=?", (m,))
+            del msgs[m]
+        more = {next(ids): random.randrange(1, 4) for _ in range(args.messages//3)}
+        await bot.db.executemany(award, ((m, next(ids), CHANNEL, GUILD, a) for m, a in more.items()))
+        msgs |= more
+        await bot.db.commit()
+
+        problems = []
+        for author in [None, 1, 2, 3]:
+            mine = [m for m, a in msgs.items() if author in (None, a)]
+            col, filt = ("ord", "") if author is None else ("author_ord", f" AND author={author}")
+            ords = sorted(o for o, in await bot.db.execute_fetchall(f"SELECT {col} FROM awarded WHERE guild=?{filt}",
+                                                                   (GUILD,)))
+            n, = await (await bot.db.execute("SELECT n FROM sizes WHERE guild=? AND author=?",
+                                             (GUILD, author or 0))).fetchone()
+            if ords != list(range(len(mine))) or n != len(mine):
+                problems.append(f"author {author}: sizes says {n}, {len(mine)} awarded, numbered {ords[:5]}...")
+                continue
+            draws = args.draws * len(mine)
+            start = time.perf_counter()
+            seen = Counter([(await bot.cog.random_awarded(GUILD, author))[0] for _ in range(draws)])
+            elapsed = time.perf_counter() - start
+            chi2 = sum((seen[m] - args.draws)**2 / args.draws for m in mine)
+            critical = chi2_critical(len(mine)-1)
+            print(f"{'everyone' if author is None else f'author {author}':>9}: {len(mine)} messages, {draws} draws "
+                  f"({elapsed/draws*1e6:.0f}µs each), chi2 {chi2:.1f} (p=0.001 at {critical:.1f})")
+            if set(seen) - set(mine): problems.append(f"author {author}: picked someone else's messages")
+            if chi2 > critical: problems.append(f"author {author}: not uniform, chi2 {chi2:.1f} > {critical:.1f}")
+        print("\n".join(problems) or "all uniform")
+        await bot.close()
+        if problems: sys.exit(1)
+
+class SharedReader(database.ReadPool):  # what we did before the read pool, reads on the writer connection
+    def __init__(self, path:str) -> None:
+        super().__init__(path)
+        self.db: aiosqlite.Connection|None = None  # set by `make_bot`
+
+    @contextlib.asynccontextmanager
+    async def __call__(self):
+        yield self.db
+
+# stars coming in at `rate` a second in the background, and every command run over and over meanwhile
+async def bench_reads(args) -> None:
+    for name, reader in [("writer connection", SharedReader), ("read pool", database.ReadPool)]:
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            bot = await make_bot(os.path.join(tmp, "bench.db"), minimum=1000, reader=reader)
+            await seed(bot.db, args.stars, 1)
+            for msg, msg_sb, author in await bot.db.execute_fetchall("SELECT msg,msg_sb,author FROM awarded"):
+                bot.messages[msg] = FakeMessage(bot, CHANNEL, msg, author)
+                bot.messages[msg_sb] = FakeMessage(bot, SB, msg_sb, 1)
+            cog, ctx, done = bot.cog, FakeContext(bot), asyncio.Event()
+            async def write() -> int:  # a burst of rate/20 stars every 50ms
+                bursts = []
+                while not done.is_set():
+                    bursts.append(asyncio.create_task(storm(bot, 5, args.rate//100)))
+                    await asyncio.sleep(0.05)
+                await asyncio.gather(*bursts)
+                return len(bursts) * 5 * (args.rate//100)
+            writer = asyncio.create_task(write())
+            latencies = {"info":[], "top":[], "random":[]}
+            start = time.perf_counter()
+            while time.perf_counter() - start < args.seconds:
+                for command, call in [("info", lambda: cog.info.callback(cog, ctx)),
+                                      ("top", lambda: cog.top.callback(cog, ctx, random.randrange(1, 50))),
+                                      ("random", lambda: cog.random.callback(cog, ctx))]:
+                    t = time.perf_counter()
+                    await call()
+                    latencies[command].append(time.perf_counter() - t)
+            done.set()
+            events = await writer
+            print(f"{name} ({events} stars in the background, {bot.cog.committer.stats['commits']} commits):")
+            for command, xs in latencies.items():
+                xs.sort()
+                print(f"  {command:>7}: p50 {xs[len(xs)//2]*1000:7.2f}ms  p99 {xs[len(xs)*99//100]*1000:7.2f}ms  "
+                      f"({len(xs)} runs)")
+            await bot.close()
+
+async def bench_pack(args) -> None:
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        bot = await make_bot(os.path.join(tmp, "bench.db"))
+        await seed(bot.db, args.stars, 1)  # all from 2015, so past any timeout
+        await bot.db.execute("UPDATE guilds SET timeout=1 WHERE guild=?", (GUILD,))
+        await bot.db.commit()
+        await bot.cog.load_guild(GUILD)
+        config = bot.cog.get_guild_info(GUILD)
+        sample = await bot.db.execute_fetchall("SELECT starrer,msg,medium FROM stars ORDER BY random() LIMIT ?",
+                                               (args.samples,))
+        async def total() -> int:
+            return (await (await bot.db.execute("SELECT sum(count) FROM counts")).fetchone())[0]
+        async def star(f, starrer:int, msg_id:int, medium:int) -> str:
+            return await bot.cog.starring(f, **config, msg_id=msg_id, msg_ch_id=CHANNEL, author_id=1,
+                                          user_id=starrer, medium=medium)
+        async def refused(f, starrer:int, msg_id:int, medium:int) -> str:  # these write nothing, no commit to wait for
+            async with bot.cog.locks(msg_id):
+                return await f(**config, msg_id=msg_id, msg_ch_id=CHANNEL, author_id=1, user_id=starrer, medium=medium)
+        async def measure(label:str) -> None:
+            pages = [(await (await bot.db.execute(f"PRAGMA {x}")).fetchone())[0]
+                     for x in ("page_count", "freelist_count", "page_size")]
+            times, wrong = {}, 0
+            for name, call, expected in [
+                    ("star again", lambda s,m,md: refused(bot.cog.add_star, s, m, md),
+                     "you already starred that, bozo!"),
+                    ("unstar, not starred", lambda s,m,md: refused(bot.cog.remove_star, 5, m, md),
+                     "you haven't starred that yet, bozo!"),
+                    ("*info", lambda s,m,md: bot.cog.read_fetchone(
+                        "SELECT coalesce(sum(count),0),count(*) FROM counts WHERE guild=?", (GUILD,)), None)]:
+                start = time.perf_counter()
+                for row in sample:
+                    if (out := await call(*row)) != expected and expected is not None: wrong += 1
+                times[name] = (time.perf_counter() - start) / len(sample)
+            print(f"{label}: {(pages[0]-pages[1])*pages[2]/2**20:.1f} MiB in use ({pages[0]*pages[2]/2**20:.1f} MiB "
+                  f"file), " + ", ".join(f"{k} {v*1e6:.0f}µs" for k,v in times.items()) + f", {wrong} wrong answers")
+        before = await total()
+        await measure("before")
+        start = time.perf_counter()
+        packed = await bot.cog.pack_timed_out()
+        print(f"packed {packed} messages in {time.perf_counter()-start:.1f}s")
+        await measure(" after")
+        problems = []
+        if (after := await total()) != before: problems.append(f"counts went from {before} to {after} stars")
+        starrer, msg_id, medium = sample[0]
+        bot.messages[msg_id] = FakeMessage(bot, CHANNEL, msg_id, 1)
+        for msg_sb, in await bot.db.execute_fetchall("SELECT msg_sb FROM awarded WHERE msg=?", (msg_id,)):
+            bot.messages[msg_sb] = FakeMessage(bot, SB, msg_sb, 1)
+        count = await bot.cog.star_count(msg_id)
+        await star(bot.cog.remove_star, starrer, msg_id, medium)
+        if await bot.cog.star_count(msg_id) != count-1: problems.append("unstarring a packed star didn't count")
+        await star(bot.cog.add_star, starrer, msg_id, medium)
+        if await bot.cog.star_count(msg_id) != count: problems.append("starring again didn't count")
+        print("\n".join(problems) or "all consistent")
+        await bot.close()
+        if problems: sys.exit(1)
+
+async def bench_dump(args) -> None:
+    problems = []
+    for fmt in ("jsonl", "csv"):
+        for stars in (args.stars//10, args.stars):
+            with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+                bot = await make_bot(os.path.join(tmp, "bench.db"))
+                await seed(bot.db, stars, 1)
+                for msg_id, in await bot.db.execute_fetchall("SELECT msg FROM counts LIMIT ?", (stars//50,)):
+                    await bot.cog.pack_message(msg_id, GUILD)  # so packed stars are in the dump too
+                await bot.db.commit()
+                everything = {table: set(await bot.db.execute_fetchall(
+                                  f"SELECT {','.join(columns)} FROM {table}")) for table, columns in
+                              starboard.DUMP_COLUMNS.items()}
+                for msg_id, starrers, mediums in await bot.db.execute_fetchall(
+                        "SELECT msg,starrers,mediums FROM packed"):
+                    everything["stars"] |= {(starrer, msg_id, GUILD, medium)
+                                            for starrer, medium in starboard.unpack(starrers, mediums).items()}
+                # once to time it, and once again to see its memory (tracemalloc makes it a lot slower)
+                os.mkdir(uploads := os.path.join(tmp, "uploads"))
+                ctx = FakeContext(bot, uploads=uploads)
+                ctx.guild.filesize_limit = args.limit
+                start = time.perf_counter()
+                await bot.cog.export.callback(bot.cog, ctx, fmt)
+                elapsed = time.perf_counter() - start
+                traced = FakeContext(bot)
+                traced.guild.filesize_limit = args.limit
+                tracemalloc.start()
+                await bot.cog.export.callback(bot.cog, traced, fmt)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                await bot.close()
+                with tempfile.TemporaryDirectory(dir=args.dir) as tmp2:
+                    bot = await make_bot(os.path.join(tmp2, "bench.db"))
+                    start = time.perf_counter()
+                    await bot.cog.importdump.callback(bot.cog, into := FakeContext(bot, ctx.files))
+                    elapsed_import = time.perf_counter() - start
+                    loaded = {table: set(await bot.db.execute_fetchall(f"SELECT {','.join(columns)} FROM {table}"))
+                              for table, columns in starboard.DUMP_COLUMNS.items()}
+                    await bot.close()
+            size = sum(f.size for f in ctx.files)
+            print(f"{fmt:>5}, {stars:>8} stars: export {elapsed:5.1f}s, {len(ctx.files)} parts, {size/2**20:5.1f} MiB, "
+                  f"peak {peak/2**20:5.1f} MiB in python; import {elapsed_import:5.1f}s ({into.sent[-1]})")
+            if any(f.size > args.limit for f in ctx.files): problems.append(f"{fmt}: a part over the limit")
+            for table in everything:
+                if everything[table] != loaded[table]:
+                    problems.append(f"{fmt}, {table}: {len(everything[table] - loaded[table])} rows missing, "
+                                    f"{len(loaded[table] - everything[table])} extra")
+    print("\n".join(problems) or "all there")
+    if problems: sys.exit(1)
+
+### SHARDS
+# guild i gets an id that puts it in shard i % shards. its starboard is the id+1 and its one channel the id+2
+def shard_guild(i:int) -> int:
+    return (1000+i) << 22
+
+def shard_worker(k:int, args, path:str, ipc_dir:str, barrier, results) -> None:
+    results.put(asyncio.run(shard_main(k, args, path, ipc_dir, barrier)))
+
+async def shard_main(k:int, args, path:str, ipc_dir:str, barrier) -> dict:
+    wait = lambda: asyncio.to_thread(barrier.wait)
+    bot = FakeBot(await database.connect(path, **database.SHARED), database.ReadPool(path), args.latency)
+    bot.shard_ids, bot.shard_count = [k], args.processes
+    bot.peers = ipc.Peers(ipc_dir, str(k), lambda message: bot.dispatch("peer_message", message))
+    await bot.peers.start()
+    await starboard.setup(bot)
+    everyone = [shard_guild(i) for i in range(args.guilds)]
+    events = []
+    for guild_id in filter(bot.cog.ours, everyone):
+        for x in (guild_id+1, guild_id+2): bot.channels[x] = FakeChannel(bot, x, "")
+        for _ in range(args.messages):
+            msg = bot.post(author_id=1, channel_id=guild_id+2)
+            events += [reaction("REACTION_ADD", msg, user, guild_id) for user in range(10, 10+args.users)]
+    random.shuffle(events)
+    await wait()  # everyone starts at once
+    start = time.perf_counter()
+    results = await asyncio.gather(*map(bot.cog.on_raw_reaction_add, events), return_exceptions=True)
+    elapsed, stars = time.perf_counter() - start, len(events)
+    await bot.cog.edits.drain()
+    problems = [f"process {k}: {x!r}" for x in Counter(repr(x) for x in results if isinstance(x, Exception))]
+    # then messages that get awarded while discord takes longer than busy_timeout: if a process kept its transaction
+    #   open across the fetch and the send, the others' writes would give up waiting for it
+    #   (the stars before the last one go in first, or their commit would end the transaction for it)
+    events = [[reaction("REACTION_ADD", msg, user, guild_id) for user in range(10, 10+args.minimum)]
+              for guild_id in filter(bot.cog.ours, everyone)
+              for msg in [bot.post(author_id=1, channel_id=guild_id+2) for _ in range(args.slow)]]
+    await asyncio.gather(*(bot.cog.on_raw_reaction_add(ev) for *before, _ in events for ev in before))
+    busy, = (await bot.db.execute_fetchall("PRAGMA busy_timeout"))[0]
+    bot.latency = busy/1000 + 1
+    events = [last for *_, last in events]
+    await wait()
+    start = time.perf_counter()
+    results = await asyncio.gather(*map(bot.cog.on_raw_reaction_add, events), return_exceptions=True)
+    slow = time.perf_counter() - start
+    await bot.cog.edits.drain()
+    bot.latency = args.latency
+    problems += [f"process {k}, slow discord: {x!r}"
+                 for x in Counter(repr(x) for x in results if isinstance(x, Exception))]
+    for guild_id in filter(bot.cog.ours, everyone):
+        minimum, _, _ = bot.cog.guilds[guild_id]
+        for msg_id, count, real, awarded in await bot.db.execute_fetchall(
+                "SELECT msg, count, (SELECT count(*) FROM stars WHERE stars.msg=counts.msg), "
+                "EXISTS(SELECT 1 FROM awarded WHERE awarded.msg=counts.msg) FROM counts WHERE guild=?", (guild_id,)):
+            if count != real or awarded != (count >= minimum):
+                problems.append(f"{msg_id}: counted {count}, {real} stars, {'' if awarded else 'not '}awarded")
+    await wait()  # everyone's done starring
+    if k == 0:  # like *starconfig, but for every guild, even the ones on other shards
+        for guild_id in everyone:
+            async with bot.cog.config_transaction(guild_id): await bot.cog.set_minimum(args.minimum+1, guild_id)
+    await wait()
+    start = time.perf_counter()
+    while True:  # the others hear about it through the sockets, soon enough
+        stale = [g for g, minimum in await bot.db.execute_fetchall("SELECT guild,minimum FROM guilds")
+                 if bot.cog.guilds[g][0] != minimum]
+        if not stale or time.perf_counter() - start > 2: break
+        await asyncio.sleep(0.01)
+    if stale: problems.append(f"process {k}: old config for {len(stale)} guilds")
+    heard = time.perf_counter() - start
+    await bot.peers.close()
+    await bot.close()
+    return {"process":k, "events":stars, "elapsed":elapsed, "slow":slow, "heard":heard, "problems":problems}
+
+async def bench_shards(args) -> None:
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        path, ipc_dir = os.path.join(tmp, "bench.db"), os.path.join(tmp, "ipc")
+        async with database.connect(path) as db:  # what main.py's supervisor does before starting the processes
+            await database.migrate(db, starboard.MIGRATIONS)
+            await db.executemany("INSERT INTO guilds(guild,sb,minimum) VALUES(?,?,?)",
+                                 [(g, g+1, args.minimum) for g in map(shard_guild, range(args.guilds))])
+            await db.commit()
+        spawn = multiprocessing.get_context("spawn")
+        barrier, results = spawn.Barrier(args.processes), spawn.Queue()
+        processes = [spawn.Process(target=shard_worker, args=(k, args, path, ipc_dir, barrier, results))
+                     for k in range(args.processes)]
+        for p in processes: p.start()
+        done = sorted([await asyncio.to_thread(results.get) for _ in processes], key=lambda r: r["process"])
+        for p in processes: p.join()
+    problems = [x for r in done for x in r["problems"]]
+    for r in done:
+        print(f"process {r['process']}: {r['events']} stars in {r['elapsed']:.2f}s ({r['events']/r['elapsed']:.0f}/s), "
+              f"{args.slow} awarded per guild with a slow discord in {r['slow']:.1f}s, "
+              f"heard about the config in {r['heard']*1000:.0f}ms")
+    print(f"{sum(r['events'] for r in done)/max(r['elapsed'] for r in done):.0f} stars/s in total")
+    print("\n".join(problems) or "all consistent")
+    if problems: sys.exit(1)
+
+### MEMORY
+# the other benches skip discord.py (FakeBot caches nothing), so this is only discord.py: a made up gateway, as the
+#   json text discord would send. GUILD_CREATEs for every guild (channels, roles, emojis, people in voice, and only
+#   them and the bot as members, like discord sends without the members intent), then the events of busy servers.
+#   an event only gets to a profile that has its intent, like in discord, and goes through the parser the gateway
+#   would call. each profile runs in a fresh process so their RSS can be compared
+GATEWAY_INTENTS = {"GUILD_CREATE":"guilds", "MESSAGE_CREATE":"guild_messages", "MESSAGE_UPDATE":"guild_messages",
+                   "MESSAGE_DELETE":"guild_messages", "MESSAGE_REACTION_ADD":"guild_reactions",
+                   "TYPING_START":"guild_typing", "VOICE_STATE_UPDATE":"voice_states"}
+# how often each kind of event comes, roughly what a busy server sends
+GATEWAY_MIX = {"TYPING_START":35, "MESSAGE_CREATE":30, "MESSAGE_REACTION_ADD":20, "VOICE_STATE_UPDATE":10,
+               "MESSAGE_UPDATE":3, "MESSAGE_DELETE":2}
+BOT_USER = {"id":"1", "username":"asteroid", "discriminator":"0", "avatar":None, "bot":True}
+TIMESTAMP = "2024-01-01T00:00:00+00:00"
+
+def fake_user(user_id:int) -> dict:
+    return {"id":str(user_id), "username":f"user{user_id}", "discriminator":"0", "global_name":f"User {user_id}",
+            "avatar":"a"*32, "bot":False}
+
+def fake_member(guild:dict, user_id:int) -> dict:
+    return {"user":fake_user(user_id), "roles":[r["id"] for r in guild["roles"][1:4]], "joined_at":TIMESTAMP,
+            "nick":None, "avatar":None, "deaf":False, "mute":False, "flags":0, "pending":False}
+
+def fake_guild(i:int, args) -> dict:
+    guild_id = shard_guild(i)
+    ids = iter(range(guild_id+1, guild_id+(1<<22)))
+    guild = {"id":str(guild_id), "name":f"guild {i}", "owner_id":"2", "icon":None, "features":[], "large":True,
+             "member_count":args.users, "unavailable":False, "verification_level":0, "mfa_level":0, "nsfw_level":0,
+             "default_message_notifications":0, "explicit_content_filter":0, "premium_tier":0, "stickers":[],
+             "preferred_locale":"en-US", "system_channel_id":None, "joined_at":TIMESTAMP, "presences":[],
+             "threads":[], "stage_instances":[], "guild_scheduled_events":[]}
+    guild["roles"] = [{"id":str(guild_id if k == 0 else next(ids)), "name":f"role {k}", "permissions":"104324673",
+                       "color":0, "hoist":False, "position":k, "managed":False, "mentionable":False}
+                      for k in range(args.roles)]
+    guild["emojis"] = [{"id":str(next(ids)), "name":f"emoji{k}", "animated":False, "available":True,
+                        "require_colons":True, "managed":False, "roles":[]} for k in range(args.emojis)]
+    guild["channels"] = [{"id":str(next(ids)), "type":0 if k < args.channels else 2, "name":f"channel-{k}",
+                          "position":k, "permission_overwrites":[], "nsfw":False, "topic":"a topic "*10,
+                          "last_message_id":None, "rate_limit_per_user":0, "parent_id":None, "bitrate":64000,
+                          "user_limit":0} for k in range(args.channels + 3)]
+    voice = [c["id"] for c in guild["channels"] if c["type"] == 2]
+    guild["members"] = [fake_member(guild, 1)] + [fake_member(guild, 100+u) for u in range(args.voice)]
+    guild["voice_states"] = [{"user_id":str(100+u), "channel_id":voice[u % len(voice)], "session_id":"s"*32,
+                              "deaf":False, "mute":False, "self_deaf":False, "self_mute":False, "self_video":False,
+                              "suppress":False, "request_to_speak_timestamp":None} for u in range(args.voice)]
+    return guild
+
+def fake_events(guilds:list[dict], args):  # (event, payload) for --events events, the same every time
+    rng = random.Random(args.seed)
+    kinds, weights = zip(*GATEWAY_MIX.items())
+    next_id = discord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc))
+    recent: dict[str, list[tuple[str, str]]] = {}  # channel: (message, author) to edit, delete or react to
+    for _ in range(args.events):
+        guild = rng.choice(guilds)
+        text = [c["id"] for c in guild["channels"] if c["type"] == 0]
+        channel_id, user_id = rng.choice(text), 100 + rng.randrange(args.users)
+        member = fake_member(guild, user_id)
+        base = {"guild_id":guild["id"], "channel_id":channel_id}
+        match rng.choices(kinds, weights)[0], recent.get(channel_id):
+            case "MESSAGE_CREATE" | "MESSAGE_UPDATE" as kind, old:
+                if kind == "MESSAGE_UPDATE" and old: msg_id, user_id = rng.choice(old)
+                else: msg_id, next_id = str(next_id), next_id+1
+                member.pop("user")
+                recent.setdefault(channel_id, []).append((msg_id, str(user_id)))
+                del recent[channel_id][:-50]
+                yield kind, base | {"id":msg_id, "author":fake_user(user_id), "member":member, "type":0, "flags":0,
+                                    "content":"words "*rng.randrange(2, 60), "timestamp":TIMESTAMP,
+                                    "edited_timestamp":TIMESTAMP if kind == "MESSAGE_UPDATE" else None,
+                                    "tts":False, "mention_everyone":False, "mentions":[], "mention_roles":[],
+                                    "attachments":[], "embeds":[], "pinned":False}
+            case "MESSAGE_DELETE", [*_, (msg_id, _)]:
+                recent[channel_id].pop()
+                yield "MESSAGE_DELETE", base | {"id":msg_id}
+            case "MESSAGE_REACTION_ADD", [*_, _] as old:
+                msg_id, author_id = rng.choice(old)
+                yield "MESSAGE_REACTION_ADD", base | {
+                    "user_id":str(user_id), "message_id":msg_id, "message_author_id":author_id, "member":member,
+                    "emoji":{"id":None, "name":rng.choice("⭐⭐⭐👍😭")}, "burst":False, "type":0}
+            case "TYPING_START", _:
+                yield "TYPING_START", base | {"user_id":str(user_id), "member":member, "timestamp":int(time.time())}
+            case "VOICE_STATE_UPDATE", _:
+                voice = [c["id"] for c in guild["channels"] if c["type"] == 2] + [None]
+                yield "VOICE_STATE_UPDATE", base | {
+                    "channel_id":rng.choice(voice), "user_id":str(user_id), "member":member, "session_id":"s"*32,
+                    "deaf":False, "mute":False, "self_deaf":False, "self_mute":False, "self_video":False,
+                    "suppress":False, "request_to_speak_timestamp":None}
+            case _:  # nothing to edit, delete or react to in there yet
+                yield "TYPING_START", base | {"user_id":str(user_id), "member":member, "timestamp":int(time.time())}
+
+def rss() -> int:  # bytes, right now. linux only, like the bot
+    with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def memory_worker(profile:str, guilds_path:str, events_path:str, results) -> None:
+    results.put(asyncio.run(memory_main(profile, guilds_path, events_path)))
+
+async def memory_main(profile:str, guilds_path:str, events_path:str) -> dict:
+    bot = asteroid.make_bot(profile=profile)
+    await bot._async_setup_hook()  # what login does first, without logging in
+    state = bot._connection
+    state.user = discord.ClientUser(state=state, data=BOT_USER)
+    out = {"profile":profile, "received":Counter()}
+    async def feed(path:str) -> float:
+        start = time.perf_counter()
+        with open(path) as f:
+            for n, line in enumerate(f):
+                event, _, data = line.partition("\t")
+                if not getattr(bot.intents, GATEWAY_INTENTS[event]): continue  # discord doesn't even send it
+                state.parsers[event](json.loads(data))
+                out["received"][event] += 1
+                if n % 100 == 0: await asyncio.sleep(0)  # for the listeners dispatch started, on_message and such
+        await asyncio.sleep(0)
+        return time.perf_counter() - start
+    gc.collect()
+    out["rss_start"] = rss()
+    out["guilds_elapsed"] = await feed(guilds_path)
+    gc.collect()
+    out["rss_guilds"] = rss()
+    out["events_elapsed"] = await feed(events_path)
+    gc.collect()
+    out["rss_events"] = rss()
+    out["messages"] = len(state._messages or ())
+    out["members"] = sum(len(guild._members) for guild in bot.guilds)
+    out["voice_states"] = sum(len(guild._voice_states) for guild in bot.guilds)
+    return out
+
+async def bench_memory(args) -> None:
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        guilds_path, events_path = os.path.join(tmp, "guilds"), os.path.join(tmp, "events")
+        guilds = [fake_guild(i, args) for i in range(args.guilds)]
+        with open(guilds_path, "w") as f:
+            for guild in guilds: f.write(f"GUILD_CREATE\t{json.dumps(guild)}\n")
+        with open(events_path, "w") as f:
+            for event, data in fake_events(guilds, args): f.write(f"{event}\t{json.dumps(data)}\n")
+        del guilds
+        spawn = multiprocessing.get_context("spawn")
+        done, results = [], spawn.Queue()
+        for profile in args.profiles or ["full", "lean"]:  # one at a time, so they don't fight over the cpu
+            p = spawn.Process(target=memory_worker, args=(profile, guilds_path, events_path, results))
+            p.start()
+            await asyncio.to_thread(p.join)
+            if p.exitcode: raise SystemExit(f"{profile} died (exit code {p.exitcode})")
+            done.append(results.get())
+    mib = lambda n: f"{n/2**20:6.1f} MiB"
+    for r in done:
+        received = sum(r["received"].values()) - r["received"]["GUILD_CREATE"]
+        print(f"{r['profile']}: rss {mib(r['rss_start'])} at start, +{mib(r['rss_guilds']-r['rss_start'])} after "
+              f"{args.guilds} guilds, +{mib(r['rss_events']-r['rss_guilds'])} after {args.events} events")
+        print(f"    {received} events received ({', '.join(f'{k} {v}' for k, v in sorted(r['received'].items()))})")
+        print(f"    {args.events/r['events_elapsed']:.0f} events/s of server activity, {r['messages']} messages, "
+              f"{r['members']} members and {r['voice_states']} voice states cached")
+
+### REPLAY
+# events go to the cog the way discord.py dispatches them, each listener call in its own task, arriving at `rate` a
+#   second (or all at once with rate=0). latency is from when the event arrives to when its handler is done
+
+async def replay(bot:FakeBot, events:list[tuple[Callable, object]], rate:float) -> dict:
+    statements = itertools.count()
+    await bot.db.set_trace_callback(lambda _: next(statements))
+    calls, latencies, errors = bot.calls.copy(), [], Counter()
+    async def handle(f, ev, arrived:float) -> None:
+        try: await f(ev)
+        except Exception as e: errors[repr(e)] += 1
+        latencies.append(time.perf_counter() - arrived)
+    tasks, start = [], time.perf_counter()
+    for i, (f, ev) in enumerate(events):
+        if rate and (wait := start + i/rate - time.perf_counter()) > 0: await asyncio.sleep(wait)
+        tasks.append(asyncio.create_task(handle(f, ev, time.perf_counter())))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    await bot.cog.edits.drain()  # the edits still waiting out their delay. they'd happen anyway, so they count
+    await bot.db.set_trace_callback(None)
+    if errors: print(f"  {sum(errors.values())} handlers failed: {errors.most_common(3)}")
+    calls = bot.calls - calls
+    rate_limited = calls.pop("429", 0)
+    latencies.sort()
+    return {"events":len(events), "events/s":len(events)/elapsed,
+            "p50 ms":latencies[len(latencies)//2]*1000, "p99 ms":latencies[len(latencies)*99//100]*1000,
+            "statements/event":(next(statements)-1)/len(events), "calls/event":calls.total()/len(events),
+            "429s":rate_limited, "errors":sum(errors.values()), "calls":dict(calls)}
+
+async def add_guild(bot:FakeBot, minimum:int) -> tuple[int, int]:  # a new configured guild, and its one channel
+    guild_id, sb_id, channel_id = next(ids), next(ids), next(ids)
+    bot.channels[sb_id] = FakeChannel(bot, sb_id, "starboard")
+    bot.channels[channel_id] = FakeChannel(bot, channel_id, "general")
+    await bot.db.execute("INSERT INTO guilds(guild,sb,minimum) VALUES(?,?,?)", (guild_id, sb_id, minimum))
+    await bot.db.commit()
+    await bot.cog.load_guild(guild_id)
+    return guild_id, channel_id
+
+# reaction events for `users` people starring `msg`. `unstars` of them take it back some time later
+def stars(bot:FakeBot, msg:FakeMessage, users:range, unstars:float=0.0, guild_id:int=GUILD) -> list[tuple]:
+    keyed = []
+    for i, user in enumerate(users):
+        keyed.append((i, (bot.cog.on_raw_reaction_add, reaction("REACTION_ADD", msg, user, guild_id))))
+        if random.random() < unstars:
+            keyed.append((random.uniform(i, len(users)),
+                          (bot.cog.on_raw_reaction_remove, reaction("REACTION_REMOVE", msg, user, guild_id))))
+    return [ev for _, ev in sorted(keyed, key=lambda x: x[0])]
+
+# every scenario sets up the bot and returns the events to replay
+async def viral(bot:FakeBot, args) -> list[tuple]:  # one message everyone stars, so every event fights for its lock
+    return stars(bot, bot.post(author_id=1), range(10, 10+args.users), unstars=0.1)
+
+async def guilds(bot:FakeBot, args) -> list[tuple]:  # lots of small guilds with a few messages each, all at once
+    events = []
+    for _ in range(args.guilds):
+        guild_id, channel_id = await add_guild(bot, args.minimum)
+        for _ in range(args.messages):
+            msg = bot.post(author_id=1, channel_id=channel_id)
+            events.append(stars(bot, msg, range(10, 10+random.randrange(1, 2*args.minimum)), 0.1, guild_id))
+    # interleave the messages, keeping each message's own events in order
+    return [ev for batch in itertools.zip_longest(*events) for ev in batch if ev is not None]
+
+async def purge(bot:FakeBot, args) -> list[tuple]:  # awarded messages bulk deleted 100 at a time, among other stars
+    victims = [bot.post(author_id=1) for _ in range(args.guilds * args.messages)]
+    await asyncio.gather(*(bot.cog.on_raw_reaction_add(reaction("REACTION_ADD", msg, 10+user))
+                           for msg in victims for user in range(args.minimum)))
+    await bot.cog.edits.drain()
+    deletes = [(bot.cog.on_raw_bulk_message_delete, bulk_delete(victims[i:i+100])) for i in range(0, len(victims), 100)]
+    chatter = [ev for _ in range(len(victims)//50)
+               for ev in stars(bot, bot.post(author_id=2), range(10, 10+args.minimum))]
+    every = max(1, len(chatter) // len(deletes))
+    return [ev for i in range(0, max(len(chatter), len(deletes)*every), every)
+            for ev in chatter[i:i+every] + deletes[i//every:i//every+1]]
+
+SCENARIOS = {"viral":viral, "guilds":guilds, "purge":purge}
+# for --against: which way is worse for each metric
+WORSE = {"events/s":-1, "p50 ms":1, "p99 ms":1, "statements/event":1, "calls/event":1}
+
+def version() -> str:
+    try: return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError: return "unknown"
+
+async def bench_replay(args) -> None:
+    limit = None if args.limit == "0" else tuple(map(float, args.limit.split("/")))
+    results = {}
+    for name in args.only or SCENARIOS:
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            bot = await make_bot(os.path.join(tmp, "bench.db"), args.minimum, args.latency, limit=limit)
+            bot.limit, bot.latency = None, 0.0  # setting up isn't what we measure
+            events = await SCENARIOS[name](bot, args)
+            bot.limit, bot.latency = limit, args.latency
+            results[name] = r = await replay(bot, events, args.rate)
+            print(f"{name:>7}: {r['events']} events, {r['events/s']:6.0f}/s, p50 {r['p50 ms']:7.1f}ms, "
+                  f"p99 {r['p99 ms']:7.1f}ms, {r['statements/event']:.2f} sql/event, {r['calls/event']:.3f} "
+                  f"discord calls/event, {r['429s']} 429s")
+            await bot.close()
+    same = {k:v for k,v in vars(args).items() if k not in ("only","save","against","tolerance")}  # what changes results
+    run = {"version":version(), "args":same, "results":results}
+    if args.save:
+        with open(args.save, "w") as f: json.dump(run, f, indent=2)
+    if not args.against: return
+    with open(args.against) as f: old = json.load(f)
+    if old["args"] != run["args"]: print(f"careful: {args.against} was run with {old['args']}")
+    problems = []
+    for name, r in results.items():
+        if (o := old["results"].get(name)) is None: continue
+        for metric, worse in WORSE.items():
+            change = (r[metric] - o[metric]) / o[metric] if o[metric] else 0.0
+            print(f"{name:>7} {metric:>16}: {o[metric]:10.2f} -> {r[metric]:10.2f} ({change:+.0%})")
+            if change * worse > args.tolerance:
+                problems.append(f"{name}: {metric} went from {o[metric]:.2f} to {r[metric]:.2f} since {old['version']}")
+    print("\n".join(problems) or f"no regressions since {old['version']}")
+    if problems: sys.exit(1)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="bench", required=True)
+    commit = sub.add_parser("commit", help="events/sec with a commit per event vs group commit")
+    commit.add_argument("--messages", type=int, default=20)
+    commit.add_argument("--users", type=int, default=100)
+    commit.add_argument("--minimum", type=int, default=1000, help="high by default, to only measure the star writes")
+    commit.add_argument("--latency", type=float, default=0.0, help="seconds every fake discord call takes")
+    commit.add_argument("--dir", default=None, help="where to put the database (fsync speed matters here)")
+    race = sub.add_parser("race", help="concurrent stars and unstars right at the minimum, checked for consistency")
+    race.add_argument("--messages", type=int, default=50)
+    race.add_argument("--users", type=int, default=6)
+    race.add_argument("--minimum", type=int, default=3)
+    race.add_argument("--latency", type=float, default=0.01, help="seconds every fake discord call takes")
+    race.add_argument("--dir", default=None, help="where to put the database")
+    plans = sub.add_parser("plans", help="query plans on a big db, checked for table scans and sorts")
+    plans.add_argument("--stars", type=int, default=1_000_000)
+    plans.add_argument("--guilds", type=int, default=50)
+    plans.add_argument("--dir", default=None, help="where to put the database")
+    rand = sub.add_parser("random", help="*random picks, checked for uniformity with a chi-square test")
+    rand.add_argument("--messages", type=int, default=300)
+    rand.add_argument("--draws", type=int, default=100, help="draws per message")
+    rand.add_argument("--dir", default=None, help="where to put the database")
+    reads = sub.add_parser("reads", help="command latency under heavy star writes, writer connection vs read pool")
+    reads.add_argument("--seconds", type=float, default=10.0)
+    reads.add_argument("--rate", type=int, default=2000, help="stars/s in the background")
+    reads.add_argument("--stars", type=int, default=100_000, help="stars in the db before starting")
+    reads.add_argument("--dir", default=None, help="where to put the database")
+    pack = sub.add_parser("pack", help="db size and star times, before and after packing timed out stars")
+    pack.add_argument("--stars", type=int, default=1_000_000)
+    pack.add_argument("--samples", type=int, default=1000, help="stars to try again and unstar")
+    pack.add_argument("--dir", default=None, help="where to put the database")
+    dump = sub.add_parser("dump", help="*export and *importdump round trip, and the export's peak memory")
+    dump.add_argument("--stars", type=int, default=500_000, help="for the big server. the small one has a tenth")
+    dump.add_argument("--limit", type=int, default=2*2**20, help="upload limit in bytes, to get several parts")
+    dump.add_argument("--dir", default=None, help="where to put the database")
+    shards = sub.add_parser("shards", help="processes sharing the db, checked for consistency and config changes")
+    shards.add_argument("--processes", type=int, default=4)
+    shards.add_argument("--guilds", type=int, default=40)
+    shards.add_argument("--messages", type=int, default=25, help="per guild")
+    shards.add_argument("--users", type=int, default=5, help="stars per message")
+    shards.add_argument("--minimum", type=int, default=3)
+    shards.add_argument("--latency", type=float, default=0.01, help="seconds every fake discord call takes")
+    shards.add_argument("--slow", type=int, default=1,
+                        help="messages per guild awarded afterwards, with discord calls slower than busy_timeout")
+    shards.add_argument("--dir", default=None, help="where to put the database")
+    memory = sub.add_parser("memory", help="RSS and events/s of discord.py's caches with the full and lean profiles")
+    memory.add_argument("--guilds", type=int, default=200)
+    memory.add_argument("--events", type=int, default=200000)
+    memory.add_argument("--users", type=int, default=5000, help="per guild, all of them chatty")
+    memory.add_argument("--voice", type=int, default=20, help="people in voice per guild at the start")
+    memory.add_argument("--channels", type=int, default=30, help="text channels per guild (and 3 voice ones)")
+    memory.add_argument("--roles", type=int, default=30)
+    memory.add_argument("--emojis", type=int, default=50)
+    memory.add_argument("--seed", type=int, default=0)
+    memory.add_argument("--profile", dest="profiles", action="append", choices=["full", "lean"],
+                        help="only this one (can be repeated)")
+    memory.add_argument("--dir", default=None, help="where to put the made up gateway")
+    replay = sub.add_parser("replay", help="event streams through the listeners: throughput, latency, sql and calls")
+    replay.add_argument("--only", action="append", choices=SCENARIOS, help="run just this scenario (can repeat)")
+    replay.add_argument("--rate", type=float, default=1000, help="events/s arriving, 0 for all at once")
+    replay.add_argument("--latency", type=float, default=0.05, help="seconds every fake discord call takes")
+    replay.add_argument("--limit", default="5/5", help="discord calls per seconds, per kind of call and channel. "
+                                                       "0 for no rate limits")
+    replay.add_argument("--minimum", type=int, default=3)
+    replay.add_argument("--users", type=int, default=2000, help="people starring the viral message")
+    replay.add_argument("--guilds", type=int, default=100)
+    replay.add_argument("--messages", type=int, default=10, help="messages per guild")
+    replay.add_argument("--save", default=None, help="write the results here, as json")
+    replay.add_argument("--against", default=None, help="compare with results saved by --save")
+    replay.add_argument("--tolerance", type=float, default=0.2, help="how much worse a metric can get, 0.2 is 20%%")
+    replay.add_argument("--dir", default=None, help="where to put the database")
+    args = parser.parse_args()
+    benches = {"commit":bench_commit, "race":bench_race, "plans":bench_plans, "random":bench_random,
+               "reads":bench_reads, "pack":bench_pack, "dump":bench_dump,
+               "shards":bench_shards,
+               "memory":bench_memory, "replay":bench_replay}
+    asyncio.run(benches[args.bench](args))
+
+if __name__ == "__main__": main()
@@ -0,0 +1,103 @@
+# opening the database and keeping its schema up to date. the schema itself is the cog's business (starboard.MIGRATIONS)
+import aiosqlite
+import asyncio
+import contextlib
+import logging
+import sqlite3
+
+import perf
+
+# set on every connection. WAL lets readers go on while a commit is being written. synchronous=FULL fsyncs the WAL on
+#   every commit, so a commit that returned is on disk (GroupCommit promises that, and makes it one fsync per batch)
+PRAGMAS = [
+    "journal_mode=WAL",
+    "synchronous=FULL",
+    "busy_timeout=5000",  # ms. only matters if something else has the file open (sqlite3 cli, backups)
+    "cache_size=-16000",  # KiB
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+]
+
+class Connection(sqlite3.Connection):
+    """sets PRAGMAS as soon as it's opened. some of them can't be changed inside a transaction, so we open in
+    autocommit mode first and only then go to what was asked for. autocommit=False is isolation_level="DEFERRED" (a
+    transaction starts before the first write and lasts until commit), on every python. sqlite3's own autocommit
+    attribute is 3.12+, and before that setting it does nothing at all"""
+
+    def __init__(self, *args, isolation_level:str|None="", autocommit:bool|None=None, **kwargs) -> None:
+        super().__init__(*args, isolation_level=None, **kwargs)
+        for pragma in PRAGMAS: self.execute("PRAGMA "+pragma)
+        match autocommit:
+            case None:  self.isolation_level = isolation_level
+            case False: self.isolation_level = "DEFERRED"
+            case True:  self.isolation_level = None
+
+    # timed for `*perf`. aiosqlite calls these in the connection's own thread, so this is the time sqlite takes, not
+    #   the wait in its queue. for selects it's up to the first row, fetching the rest happens later
+    def execute(self, sql:str, *args) -> sqlite3.Cursor:
+        with perf.time_sql(sql): return super().execute(sql, *args)
+
+    def executemany(self, sql:str, *args) -> sqlite3.Cursor:
+        with perf.time_sql(sql): return super().executemany(sql, *args)
+
+    def executescript(self, script:str) -> sqlite3.Cursor:
+        with perf.metrics.time("sql", "(script)"): return super().executescript(script)
+
+    def commit(self) -> None:
+        with perf.metrics.time("sql", "COMMIT"): super().commit()
+
+def connect(path:str, **kwargs) -> aiosqlite.Connection:  # same as aiosqlite.connect
+    return aiosqlite.connect(path, factory=Connection, **kwargs)
+
+# connect(path, **SHARED) for a writer when other processes write to the same db. transactions start with BEGIN
+#   IMMEDIATE, taking the write lock before reading anything. with deferred ones two processes can both read, and then
+#   the second to write fails right away with SQLITE_BUSY, because its snapshot is stale. busy_timeout doesn't help
+#   there. this way the second one waits for the lock instead
+SHARED = {"isolation_level": "IMMEDIATE"}
+
+# brings the db up to date with `migrations`. migration n (counting from 1) is applied to databases with user_version<n,
+#   each in its own transaction along with the bump in user_version
+async def migrate(db:aiosqlite.Connection, migrations:list[str]) -> None:
+    version, = await (await db.execute("PRAGMA user_version")).fetchone()
+    if version > len(migrations): raise RuntimeError(f"db is at version {version} but i only know {len(migrations)}")
+    for n, sql in enumerate(migrations[version:], version+1):
+        logging.info("migrating db to version %d", n)
+        await db.commit()
+        script = f"{sql}\nPRAGMA user_version={n};"
+        await db.executescript(f"BEGIN;\n{script}\nCOMMIT;")
+        await db.commit()
+
+# the writer (bot.db) runs one query at a time, so a read queues behind every star write and commit before it. reads
+#   that don't have to see uncommitted writes (the user commands) go through this instead
+READERS = 4
+
+class ReadPool:
+    """up to `size` read-only connections to the db at `path`, opened the first time they're needed. in WAL mode they
+    read the last commit without waiting for the writer. `async with pool() as db:` borrows one.
+
+    `close` closes the ones not in use. the pool can still be used after, it opens them again"""
+
+    def __init__(self, path:str, size:int=READERS) -> None:
+        self.path = path
+        self.slots = asyncio.Semaphore(size)
+        self.idle: list[aiosqlite.Connection] = []
+
+    @contextlib.asynccontextmanager
+    async def __call__(self):
+        async with self.slots:
+            db = self.idle.pop() if self.idle else \
+                await connect(f"file:{self.path}?mode=ro", uri=True, isolation_level=None)
+            try:
+                yield db
+            finally:
+                self.idle.append(db)
+
+    async def close(self) -> None:
+        idle, self.idle = self.idle, []
+        for db in idle: await db.close()
+
+    async def __aenter__(self) -> "ReadPool":
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
@@ -0,0 +1,59 @@
+# processes of the same bot (see `main.py`, with PROCESSES>1) telling each other things, so far only that a guild's
+#   config changed. every process binds a unix datagram socket in the same directory, and sending is sending to all
+#   the others there. a datagram that can't be delivered (that process is gone or restarting) is dropped: it's only
+#   about caches, and a process that starts reads everything from the db anyway
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import socket
+from typing import Callable
+
+class Peers:
+    """`send` gives a json-able dict to all the other processes, and they get it in `received`. with directory=None
+    there are no others, and `send` does nothing. `async with` (or `start`/`close`) binds and unbinds the socket"""
+
+    def __init__(self, directory:str|None, name:str="", received:Callable[[dict], None]=lambda _: None) -> None:
+        self.directory, self.received = directory, received
+        self.path = directory and os.path.join(directory, f"{name or os.getpid()}.sock")
+        self.transport: asyncio.DatagramTransport|None = None
+
+    async def start(self) -> None:
+        if self.directory is None: return
+        os.makedirs(self.directory, exist_ok=True)
+        with contextlib.suppress(FileNotFoundError): os.unlink(self.path)  # left over by the last one with this name
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: Protocol(self), local_addr=self.path, family=socket.AF_UNIX)
+
+    def send(self, message:dict) -> None:
+        if self.transport is None: return
+        data = json.dumps(message).encode()
+        for name in os.listdir(self.directory):
+            if name.endswith(".sock") and (path := os.path.join(self.directory, name)) != self.path:
+                self.transport.sendto(data, path)
+
+    async def close(self) -> None:
+        if self.transport is None: return
+        self.transport.close()
+        self.transport = None
+        with contextlib.suppress(FileNotFoundError): os.unlink(self.path)
+
+    async def __aenter__(self) -> "Peers":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+class Protocol(asyncio.DatagramProtocol):
+    def __init__(self, peers:Peers) -> None:
+        self.peers = peers
+
+    def datagram_received(self, data:bytes, _) -> None:
+        try: message = json.loads(data)
+        except ValueError: return logging.warning("got a weird datagram: %r", data[:100])
+        self.peers.received(message)
+
+    def error_received(self, exc:OSError) -> None:  # sending to a process that's not there
+        logging.debug("couldn't tell a peer: %s", exc)
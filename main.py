@@ -1,65 +1,192 @@
 import discord
-import discord.app_commands as app_commands
 import discord.ext.commands as commands
-import aiosqlite
 import asyncio
 import datetime
 import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.connection
 import os
+import queue
+import shutil
+import signal
+import sys
+import time
 
-os.makedirs("logs", exist_ok=True)
-discord.utils.setup_logging(level=logging.DEBUG)
-discord.utils.setup_logging(level=logging.DEBUG, handler=logging.FileHandler(
-    f'logs/asteroid-{datetime.date.today().isoformat()}.log'))
+import database
+import ipc
+import perf
+import starboard
 
-intents = discord.Intents().default()
-intents.message_content = True
-bot=commands.Bot(intents=intents, command_prefix=commands.when_mentioned_or("*", "\\*"))
+DB = "bees.db"
+# SHARDS=n runs n shards, spread over PROCESSES=k processes (1 by default) that all share DB. without SHARDS it's one
+#   unsharded bot. with more than one process, this one only migrates the db and starts them (and starts them again
+#   WORKER_RESTART seconds after they die), and they tell each other about config changes through sockets in IPC_DIR
+SHARDS = int(os.environ["SHARDS"]) if os.environ.get("SHARDS") else None
+PROCESSES = int(os.environ.get("PROCESSES", "1"))
+IPC_DIR = os.environ.get("IPC_DIR", "ipc")
+WORKER_RESTART = 5.0
+# PROFILE=lean asks discord for only what the starboard uses: guilds and channels, messages (for deletes and edits,
+#   and commands. message_content because that's also what lets fetched messages have content), reactions, and DMs
+#   for the owner commands. no typing, voice states, emojis, invites, etc, which are most of a big server's events.
+#   and it caches nothing it doesn't need: no messages (the starboard fetches its own, see "uselesscore") and no
+#   members other than the bot. PROFILE=full (the default) is discord.py's defaults, with message_content
+PROFILE = os.environ.get("PROFILE", "full")
 
-@bot.event
-async def on_ready():
-    print("i'm in "+", ".join(x.name for x in bot.guilds))
+# handlers only put records in a queue. a thread of its own writes them to the console and the day's file, so nothing
+#   waits for the disk in the middle of an event. LOG_LEVEL is for everything, DISCORD_LOG_LEVEL for discord.py (at
+#   DEBUG it logs every gateway event, and then they're not free even through the queue). call in every process
+def setup_logging(name:str) -> logging.handlers.QueueListener:
+    os.makedirs("logs", exist_ok=True)
+    log_queue = queue.SimpleQueue()
+    log_handlers = [logging.StreamHandler(),
+                    logging.FileHandler(f'logs/{name}-{datetime.date.today().isoformat()}.log')]
+    for handler in log_handlers:
+        handler.setFormatter(logging.Formatter("[{asctime}] [{levelname:<8}] {processName} {name}: {message}",
+                                               "%Y-%m-%d %H:%M:%S", style="{"))
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+    logging.getLogger().setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    logging.getLogger("discord").setLevel(os.environ.get("DISCORD_LOG_LEVEL", "INFO").upper())
+    return logging.handlers.QueueListener(log_queue, *log_handlers)
 
-@bot.command()
+@commands.command()
 @commands.is_owner()
-async def reload(ctx:commands.Context, x:str): await bot.reload_extension(x); await ctx.send("ok")
+async def reload(ctx:commands.Context, x:str): await ctx.bot.reload_extension(x); await ctx.send("ok")
 
-@bot.command()
+@commands.command()
 @commands.is_owner()
-async def unload(ctx:commands.Context, x:str): await bot.unload_extension(x); await ctx.send("ok")
+async def unload(ctx:commands.Context, x:str): await ctx.bot.unload_extension(x); await ctx.send("ok")
 
-@bot.command()
+@commands.command()
 @commands.is_owner()
-async def load  (ctx:commands.Context, x:str): await bot.load_extension(x); await ctx.send("ok")
+async def load  (ctx:commands.Context, x:str): await ctx.bot.load_extension(x); await ctx.send("ok")
 
-@bot.command()
+@commands.command()
 @commands.is_owner()
 async def sql(ctx:commands.Context, *, query:str):
-    await ctx.send(str(await bot.db.execute_fetchall(query)))
+    await ctx.send(str(await ctx.bot.db.execute_fetchall(query)))
 
-@bot.command()
+@commands.command()
 @commands.is_owner()
 async def python(ctx:commands.Context, *, query:str):
     exec("async def command(bot,ctx):\n " + query.replace("\n", "\n "), env:={"discord":discord, "commands":commands})
     try:
-        out = await env["command"](bot,ctx)
+        out = await env["command"](ctx.bot,ctx)
     except Exception as exc:
         await ctx.send(f"{exc} :(")
         logging.exception(":(", exc_info=exc)
     else:
         await ctx.send(str(out)[:2000])
 
-@bot.command()
+# *perf shows everything, *perf sql (or event, command, http) more of one kind, *perf reset starts over. each process
+#   has its own, this is the one with the guild's shard
+@commands.command(name="perf")
+@commands.is_owner()
+async def perf_command(ctx:commands.Context, what:str="all"):
+    match what:
+        case "reset":
+            perf.metrics.reset()
+            return await ctx.send("ok")
+        case "all":
+            txt = "\n\n".join(perf.metrics.report(family, 5) for family in perf.FAMILIES)
+            txt += "\n\n" + " ".join(f"{k}={v:g}" for k,v in sorted(perf.metrics.counters.items()))
+            txt += "\n\n" + " ".join(f"{k}={v:g}" for k,v in perf.metrics.read_sources().items())
+        case family if family in perf.FAMILIES:
+            txt = perf.metrics.report(family, 20)
+        case _:
+            return await ctx.send(f"one of all, reset, {', '.join(perf.FAMILIES)}")
+    since = datetime.datetime.fromtimestamp(perf.metrics.since, datetime.timezone.utc)
+    await ctx.send(f"since {discord.utils.format_dt(since, 'R')}\n```\n{txt[:1900]}\n```")
+
+@commands.command()
 @commands.is_owner()
 async def sync(ctx:commands.Context):
-    await bot.tree.sync()
+    await ctx.bot.tree.sync()
     await ctx.send("ok")
 
-async def do():
-    bot.db = aiosqlite.connect("bees.db", autocommit=False)
-    async with bot, bot.db:
-        await bot.load_extension("starboard")
-        with open("token") as f: tok=f.read().strip()
-        await bot.start(tok)
+def client_options(profile:str) -> dict:
+    match profile:
+        case "full":
+            intents = discord.Intents().default()
+            intents.message_content = True
+            return {"intents":intents}
+        case "lean":
+            intents = discord.Intents(guilds=True, guild_messages=True, guild_reactions=True, message_content=True,
+                                      dm_messages=True)
+            return {"intents":intents, "max_messages":None, "member_cache_flags":discord.MemberCacheFlags.none(),
+                    "chunk_guilds_at_startup":False}
+        case _:
+            raise SystemExit(f"PROFILE is full or lean, not {profile!r}")
+
+def make_bot(shard_ids:list[int]|None=None, profile:str=PROFILE) -> commands.Bot:
+    kwargs = {"command_prefix":commands.when_mentioned_or("*", "\\*"), **client_options(profile)}
+    if SHARDS is None: bot = perf.Bot(**kwargs)
+    else:              bot = perf.AutoShardedBot(shard_count=SHARDS, shard_ids=shard_ids, **kwargs)
+    for command in (reload, unload, load, sql, python, perf_command, sync): bot.add_command(command)
+
+    @bot.event
+    async def on_ready():
+        print("i'm in "+", ".join(x.name for x in bot.guilds))
+    return bot
+
+# name is what this process' logs and metrics are called. with shared=True the db is written by other processes too
+async def run(bot:commands.Bot, name:str, shared:bool, peers:ipc.Peers) -> None:
+    bot.db = database.connect(DB, **(database.SHARED if shared else {"autocommit":False}))
+    bot.reader = database.ReadPool(DB)
+    bot.peers = peers
+    # PERF_FILE is where the metrics go in prometheus' text format ({} is the name). empty to not write them
+    prometheus = (path := os.environ.get("PERF_FILE", "logs/{}.prom").format(name)) and \
+        asyncio.create_task(perf.write_prometheus(path))
+    try:
+        async with bot, bot.db, bot.reader, bot.peers:
+            await bot.load_extension("starboard")
+            with open("token") as f: tok=f.read().strip()
+            await bot.start(tok)
+    finally:
+        if prometheus: prometheus.cancel()
+
+def worker(k:int) -> None:  # process k of PROCESSES, with every PROCESSES-th shard starting from k
+    log_listener = setup_logging(f"asteroid-{k}")
+    log_listener.start()
+    try:
+        bot = make_bot([i for i in range(SHARDS) if i % PROCESSES == k])
+        peers = ipc.Peers(IPC_DIR, str(k), lambda message: bot.dispatch("peer_message", message))
+        asyncio.run(run(bot, f"asteroid-{k}", True, peers))
+    finally:
+        log_listener.stop()
+
+async def migrate() -> None:  # before starting the workers, so they don't all try at once
+    async with database.connect(DB) as db:
+        await database.migrate(db, starboard.MIGRATIONS)
 
-asyncio.run(do())
+def supervise() -> None:
+    if SHARDS is None or SHARDS < PROCESSES: raise SystemExit("PROCESSES needs SHARDS, at least as many")
+    asyncio.run(migrate())
+    shutil.rmtree(IPC_DIR, ignore_errors=True)
+    spawn = multiprocessing.get_context("spawn")  # a fresh interpreter each, no event loop or sockets from this one
+    workers = {}
+    def start(k:int) -> None:
+        workers[k] = spawn.Process(target=worker, args=(k,), name=f"asteroid-{k}")
+        workers[k].start()
+    for k in range(PROCESSES): start(k)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # so the finally below takes the workers down too
+    try:
+        while True:
+            multiprocessing.connection.wait([p.sentinel for p in workers.values()])
+            for k, p in list(workers.items()):
+                if p.is_alive(): continue
+                logging.error("process %d died (exit code %s), starting it again", k, p.exitcode)
+                time.sleep(WORKER_RESTART)
+                start(k)
+    finally:
+        for p in workers.values(): p.terminate()
+        for p in workers.values(): p.join()
+
+if __name__ == "__main__":
+    log_listener = setup_logging("asteroid")
+    log_listener.start()
+    try:
+        if PROCESSES > 1: supervise()
+        else:             asyncio.run(run(make_bot(), "asteroid", False, ipc.Peers(None)))
+    finally:
+        log_listener.stop()
@@ -0,0 +1,208 @@
+# where the time goes: latency histograms for every listener, command, sql statement and discord request, and counts
+#   of rate limits. all of it goes in `metrics`, which `*perf` reads and `write_prometheus` dumps to a file
+import discord
+import discord.app_commands as app_commands
+import discord.ext.commands as commands
+import aiohttp
+import asyncio
+import bisect
+import contextlib
+import functools
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Callable
+
+# upper bounds of the histogram buckets, in seconds. the last bucket (+Inf) is everything slower
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+FAMILIES = {  # what gets timed, and what its label is
+    "event":   "listener, by its qualified name",
+    "command": "prefix or app command, by its name",
+    "sql":     "sql statement, with whitespace and long lists of ? squashed. time in sqlite, not in the queue",
+    "http":    "discord request, by method and route. includes waiting for rate limits",
+}
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS)+1)
+        self.sum = 0.0
+
+    def observe(self, seconds:float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q:float) -> float:  # interpolated inside the bucket, like prometheus' histogram_quantile
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = BUCKETS[i-1] if i else 0.0
+                if i == len(BUCKETS): return low
+                return low + (BUCKETS[i]-low) * (rank-seen) / n
+            seen += n
+        return 0.0
+
+class Metrics:
+    """histograms by (family, label), and plain counters. sql is timed from the database threads, so everything goes
+    through a lock. and sources: numbers other objects keep themselves (like the cog's caches' stats), read when
+    they're reported"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.histograms: dict[tuple[str,str], Histogram] = {}
+        self.counters = Counter()
+        self.sources: dict[str, Callable[[], dict]] = {}
+        self.since = time.time()
+
+    def observe(self, family:str, label:str, seconds:float) -> None:
+        with self.lock:
+            if (h := self.histograms.get((family, label))) is None:
+                h = self.histograms[family, label] = Histogram()
+            h.observe(seconds)
+
+    def count(self, name:str, n:float=1) -> None:
+        with self.lock:
+            self.counters[name] += n
+
+    @contextlib.contextmanager
+    def time(self, family:str, label:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(family, label, time.perf_counter() - start)
+
+    # `read` gives a dict of numbers, which show up as `name`_key. they belong to whoever registered them, so `reset`
+    #   doesn't touch them, and they start over when that does (a reloaded cog). read=None unregisters
+    def source(self, name:str, read:Callable[[], dict]|None) -> None:
+        with self.lock:
+            if read is None: self.sources.pop(name, None)
+            else:            self.sources[name] = read
+
+    def read_sources(self) -> dict[str, float]:  # call from the event loop, that's where the sources live
+        with self.lock: sources = dict(self.sources)
+        return {f"{name}_{key}": value for name, read in sorted(sources.items())
+                for key, value in read().items() if isinstance(value, int|float)}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.since = time.time()
+
+    # a table for `*perf`: the `top` labels of `family` that took the most time in total
+    def report(self, family:str, top:int=8) -> str:
+        with self.lock:
+            rows = sorted(((label, h.count, h.sum, h.quantile(0.5), h.quantile(0.99))
+                           for (f, label), h in self.histograms.items() if f == family), key=lambda r: -r[2])
+        lines = [f"{family}: {len(rows)} kinds, {sum(r[1] for r in rows)} total"]
+        for label, n, total, p50, p99 in rows[:top]:
+            lines.append(f"{n:>7} {total:8.2f}s p50 {p50*1000:7.1f}ms p99 {p99*1000:7.1f}ms  {label[:60]}")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:  # the text exposition format, for node_exporter's textfile collector or similar
+        sources = self.read_sources()
+        with self.lock:
+            histograms = {k: (list(h.counts), h.sum) for k, h in self.histograms.items()}
+            counters = dict(self.counters)
+        out = []
+        for family in FAMILIES:
+            name = f"asteroid_{family}_seconds"
+            out.append(f"# HELP {name} {FAMILIES[family]}\n# TYPE {name} histogram")
+            for (f, label), (counts, total) in sorted(histograms.items()):
+                if f != family: continue
+                label, cumulative = escape(label), 0
+                for bound, n in zip([*map(str, BUCKETS), "+Inf"], counts):
+                    cumulative += n
+                    out.append(f'{name}_bucket{{name="{label}",le="{bound}"}} {cumulative}')
+                out.append(f'{name}_sum{{name="{label}"}} {total}')
+                out.append(f'{name}_count{{name="{label}"}} {cumulative}')
+        for counter, n in sorted(counters.items()):
+            out.append(f"# TYPE asteroid_{counter}_total counter\nasteroid_{counter}_total {n}")
+        for source, n in sources.items():  # some count up, some don't. they all start over with their objects anyway
+            out.append(f"# TYPE asteroid_{source} gauge\nasteroid_{source} {n}")
+        out.append(f"# TYPE asteroid_metrics_since_seconds gauge\nasteroid_metrics_since_seconds {self.since}")
+        return "\n".join(out) + "\n"
+
+def escape(label:str) -> str:
+    return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+
+# so that `IN (?,?,?)` with a different number of messages each time doesn't make a new label every time
+@functools.lru_cache(maxsize=1024)
+def sql_label(sql:str) -> str:
+    return re.sub(r"\?(\s*,\s*\?){3,}", "?,...", " ".join(sql.split()))
+
+def time_sql(sql:str):
+    return metrics.time("sql", sql_label(sql))
+
+# writes `metrics.prometheus()` to `path` every `interval` seconds. written to a temporary file and renamed, so a
+#   scraper never reads half of it
+PROMETHEUS_INTERVAL = 30.0
+
+async def write_prometheus(path:str, interval:float=PROMETHEUS_INTERVAL) -> None:
+    def write(text:str) -> None:
+        with open(path+".tmp", "w") as f: f.write(text)
+        os.replace(path+".tmp", path)
+    while True:
+        try: await asyncio.to_thread(write, metrics.prometheus())
+        except OSError: logging.exception("couldn't write metrics to %s", path)
+        await asyncio.sleep(interval)
+
+### HOOKS
+# discord.py doesn't have a place to time every event or request, so these go in at the lowest level that still has
+#   names: `_run_event` runs every listener (cogs' too), `CommandTree._call` every app command, and `HTTPClient.request`
+#   every request, rate limits and retries included. the 429s are seen in aiohttp, as discord.py retries them inside
+
+def ratelimit_trace() -> aiohttp.TraceConfig:
+    """counts every 429 response, and how long discord said to wait. waits discord.py does before asking (when it
+    knows the bucket is empty) aren't 429s, but they're in the http histograms anyway"""
+    async def on_request_end(session, context, params:aiohttp.TraceRequestEndParams) -> None:
+        if params.response.status != 429: return
+        headers = params.response.headers
+        if headers.get("X-RateLimit-Global"):
+            metrics.count("global_ratelimits")
+            return
+        metrics.count("ratelimits")
+        try: metrics.count("ratelimit_wait_seconds", float(headers.get("X-RateLimit-Reset-After")
+                                                           or headers.get("Retry-After") or 0))
+        except ValueError: pass
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+class Tree(app_commands.CommandTree):
+    async def _call(self, interaction:discord.Interaction) -> None:
+        name = interaction.data.get("name", "?") if interaction.data else "?"
+        with metrics.time("command", "/"+name):
+            await super()._call(interaction)
+
+class Instrumented:  # goes before commands.Bot or commands.AutoShardedBot
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, tree_cls=Tree, http_trace=ratelimit_trace(), **kwargs)
+        request = self.http.request
+        async def timed_request(route, **kwargs):
+            with metrics.time("http", f"{route.method} {route.path}"):
+                return await request(route, **kwargs)
+        self.http.request = timed_request
+
+    async def _run_event(self, coro, event_name:str, *args, **kwargs) -> None:
+        with metrics.time("event", getattr(coro, "__qualname__", event_name)):
+            await super()._run_event(coro, event_name, *args, **kwargs)
+
+    async def invoke(self, ctx:commands.Context) -> None:
+        if ctx.command is None: return await super().invoke(ctx)
+        with metrics.time("command", ctx.command.qualified_name):
+            await super().invoke(ctx)
+
+class Bot(Instrumented, commands.Bot): pass
+class AutoShardedBot(Instrumented, commands.AutoShardedBot): pass
@@ -16,7 +16,11 @@ FROM_MENU = 2
 # timeout_d (interval in days) is optional. after timeout_d passes from the message being sent, the message will be
 #   locked in its awarded/unawarded state. however, star counts are still updated.
 
-SCHEMA = f"""
+# the schema, as migrations applied in order by `database.migrate`. add new ones at the end, never edit old ones.
+#   the first two use IF NOT EXISTS because they were a single script before, and older dbs already have all of it
+MIGRATIONS = [
+# 1: the original tables
+"""
 CREATE TABLE IF NOT EXISTS guilds(
     guild   INTEGER PRIMARY KEY,
     minimum INTEGER NOT NULL DEFAULT 3,
@@ -38,7 +42,119 @@ CREATE TABLE IF NOT EXISTS stars(
     UNIQUE(starrer, msg)
 );
 CREATE INDEX IF NOT EXISTS idx_starred ON stars(msg);
+""",
+# 2: star count of every starred message, so we don't have to count(*) the stars every time. kept in sync with stars by
+#   the triggers, so every path that inserts or deletes stars updates it (ignored INSERT OR IGNOREs don't fire).
+#   the backfill recounts everything, so it's fine to run on dbs that had counts already
+"""
+CREATE TABLE IF NOT EXISTS counts(
+    msg     INTEGER PRIMARY KEY,
+    guild   INTEGER NOT NULL,
+    count   INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_counts ON counts(guild, count); -- also the *top ranking, walked backwards (no sorting)
+CREATE TRIGGER IF NOT EXISTS star_added AFTER INSERT ON stars BEGIN
+    INSERT INTO counts(msg,guild,count) VALUES(new.msg,new.guild,1) ON CONFLICT(msg) DO UPDATE SET count=count+1;
+END;
+CREATE TRIGGER IF NOT EXISTS star_removed AFTER DELETE ON stars BEGIN
+    UPDATE counts SET count=count-1 WHERE msg=old.msg;
+    DELETE FROM counts WHERE msg=old.msg AND count<=0;
+END;
+INSERT OR REPLACE INTO counts(msg,guild,count) SELECT msg,guild,count(*) FROM stars GROUP BY msg;
+""",
+# 3: covering index for awarded by guild, so those queries don't go to the table (msg is the rowid, every index has it).
+#   *info, *random (by user or not), *top by user. see `python bench.py plans`. the ANALYZE is so that sqlite knows a
+#   guild has many more messages than an author in it, and goes through this index for *top by user
+"""
+DROP INDEX IF EXISTS idx_awarded_author;
+CREATE INDEX idx_awarded_guild ON awarded(guild, author, msg_ch);
+ANALYZE;
+""",
+# 4: awarded messages get numbered 0..n-1 in their guild (ord) and among their author's in the guild (author_ord), so
+#   *random can pick a number and look it up. n is kept in sizes (author 0 is the whole guild). when a message is
+#   unawarded, the last one takes its number, so the numbers stay dense
 """
+ALTER TABLE awarded ADD COLUMN ord INTEGER;
+ALTER TABLE awarded ADD COLUMN author_ord INTEGER;
+UPDATE awarded SET ord=o.ord, author_ord=o.author_ord FROM (
+    SELECT msg, row_number() OVER (PARTITION BY guild ORDER BY msg)-1 AS ord,
+                row_number() OVER (PARTITION BY guild, author ORDER BY msg)-1 AS author_ord FROM awarded
+) AS o WHERE awarded.msg=o.msg;
+CREATE TABLE sizes(
+    guild   INTEGER NOT NULL,
+    author  INTEGER NOT NULL, -- 0 for all of them
+    n       INTEGER NOT NULL,
+    PRIMARY KEY(guild, author)
+);
+INSERT INTO sizes(guild,author,n) SELECT guild,0,count(*) FROM awarded GROUP BY guild
+                            UNION ALL SELECT guild,author,count(*) FROM awarded GROUP BY guild,author;
+DROP INDEX idx_awarded_guild; -- these two cover everything it did
+CREATE INDEX idx_awarded_ord ON awarded(guild, ord, msg_ch);
+CREATE INDEX idx_awarded_author_ord ON awarded(guild, author, author_ord, msg_ch);
+CREATE TRIGGER awarded_added AFTER INSERT ON awarded BEGIN
+    INSERT INTO sizes(guild,author,n) VALUES(new.guild,0,1),(new.guild,new.author,1)
+        ON CONFLICT(guild,author) DO UPDATE SET n=n+1;
+    UPDATE awarded SET ord=(SELECT n-1 FROM sizes WHERE guild=new.guild AND author=0),
+                       author_ord=(SELECT n-1 FROM sizes WHERE guild=new.guild AND author=new.author)
+        WHERE msg=new.msg;
+END;
+CREATE TRIGGER awarded_removed AFTER DELETE ON awarded BEGIN
+    UPDATE awarded SET ord=old.ord
+        WHERE guild=old.guild AND ord=(SELECT n-1 FROM sizes WHERE guild=old.guild AND author=0);
+    UPDATE awarded SET author_ord=old.author_ord
+        WHERE guild=old.guild AND author=old.author
+          AND author_ord=(SELECT n-1 FROM sizes WHERE guild=old.guild AND author=old.author);
+    UPDATE sizes SET n=n-1 WHERE guild=old.guild AND author IN (0, old.author);
+    DELETE FROM sizes WHERE guild=old.guild AND author IN (0, old.author) AND n<=0;
+END;
+ANALYZE;
+""",
+# 5: import_rdanny checkpoints. last is the last message of the R. Danny starboard that was imported
+"""
+CREATE TABLE imports(
+    sb      INTEGER PRIMARY KEY, -- R. Danny's starboard channel
+    guild   INTEGER NOT NULL,
+    last    INTEGER NOT NULL,
+    scanned INTEGER NOT NULL     -- how many messages were imported so far
+);
+""",
+# 6: the last time (as a snowflake) we were connected and caught up with every guild's events, see `reconcile`
+"""
+CREATE TABLE watermarks(
+    guild   INTEGER PRIMARY KEY,
+    seen    INTEGER NOT NULL
+);
+""",
+# 7: the stars of messages past their guild's timeout, moved out of stars into one row per message by `sweep`. see
+#   `pack_message`. counts keeps counting them, through the triggers
+"""
+CREATE TABLE packed(
+    msg      INTEGER PRIMARY KEY,
+    guild    INTEGER NOT NULL,
+    starrers BLOB NOT NULL, -- user ids, 8 bytes each
+    mediums  BLOB NOT NULL  -- and their mediums, a byte each
+);
+CREATE TRIGGER packed_added AFTER INSERT ON packed BEGIN
+    INSERT INTO counts(msg,guild,count) VALUES(new.msg,new.guild,length(new.mediums))
+        ON CONFLICT(msg) DO UPDATE SET count=count+length(new.mediums);
+END;
+CREATE TRIGGER packed_changed AFTER UPDATE ON packed BEGIN
+    INSERT INTO counts(msg,guild,count) VALUES(new.msg,new.guild,length(new.mediums)-length(old.mediums))
+        ON CONFLICT(msg) DO UPDATE SET count=count+length(new.mediums)-length(old.mediums);
+    DELETE FROM counts WHERE msg=new.msg AND count<=0;
+END;
+CREATE TRIGGER packed_removed AFTER DELETE ON packed BEGIN
+    UPDATE counts SET count=count-length(old.mediums) WHERE msg=old.msg;
+    DELETE FROM counts WHERE msg=old.msg AND count<=0;
+END;
+""",
+# 8: a guild's recent starred and awarded messages, for `reconcile_guild`. on counts (a row per message) and not on
+#   stars, which would take one more index write per star for something done once per connect
+"""
+CREATE INDEX idx_counts_recent ON counts(guild, msg);
+CREATE INDEX idx_awarded_recent ON awarded(guild, msg_sb);
+""",
+]
 
 import discord
 import discord.app_commands as app_commands
@@ -48,9 +164,133 @@ import asyncio
 import datetime
 import re
 import logging
+import contextlib
+import database
+import ipc
+import math
+import perf
+import array
+import sys
+import random
+import time
+import csv
+import gzip
+import io
+import itertools
+import json
+import tempfile
+from collections import OrderedDict
 from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterator, Literal
 
 FLAG_FORWARDED = 16384
+# edits to a starboard message wait until it gets no stars for EDIT_QUIET seconds, but no longer than EDIT_MAX_DELAY
+#   seconds after the first star. every star in between is folded into the same edit
+EDIT_QUIET = 2.0
+EDIT_MAX_DELAY = 10.0
+# star writes are committed together (one fsync for all of them), COMMIT_INTERVAL seconds after the first one or as
+#   soon as COMMIT_BATCH of them are waiting
+COMMIT_INTERVAL = 0.05
+COMMIT_BATCH = 64
+# tracked messages (see `Starboard.tracked`) are kept in a bloom filter with this false positive rate, sized for twice
+#   the messages there are at startup (and at least TRACKED_MIN)
+TRACKED_FPR = 0.01
+TRACKED_MIN = 1<<16
+VERDICTS_SIZE = 4096  # how many channels and threads to remember `channel_allowed` for (threads come and go)
+RENDERED_SIZE = 4096  # how many starboard messages to remember the contents of, to skip edits that change nothing
+SB_DELETES = 5  # starboard messages too old to bulk delete are deleted one by one, this many at a time
+# fetched messages are kept (as `Snapshot`s) for MESSAGES_TTL seconds, and at most MESSAGES_SIZE of them
+MESSAGES_SIZE = 1024
+MESSAGES_TTL = 300.0
+# *top shows TOP_PAGE messages a page. rendered pages are kept until the guild's ranking changes (see
+#   `Starboard.rerank`) or for PAGES_TTL seconds, so messages leaving the week/month windows (or renamed authors) show
+#   up eventually
+TOP_PAGE = 10
+PAGES_SIZE = 256
+PAGES_TTL = 600.0
+WINDOWS = {"week":7, "month":30, "all":None}  # in days
+# import_rdanny reads the history IMPORT_CHUNK messages at a time, with up to IMPORT_FETCHES requests at once, and
+#   updates its status message every IMPORT_PROGRESS seconds
+IMPORT_CHUNK = 100
+IMPORT_FETCHES = 8
+IMPORT_PROGRESS = 5.0
+RDANNY = 80528701850124288
+# after connecting, reactions we missed are caught up on (see `Starboard.reconcile`) in messages from RECONCILE_DAYS
+#   before the last time we were surely online, which is saved every WATERMARK_INTERVAL seconds. it makes at most
+#   RECONCILE_FETCHES requests at a time, so live stars don't wait on it
+RECONCILE_DAYS = 3
+RECONCILE_FETCHES = 2
+WATERMARK_INTERVAL = 60.0
+SWEEP_INTERVAL = 3600.0  # how often to look for messages past their timeout, to pack their stars
+SWEEP_BATCH = 500  # commit after packing this many messages
+# *export reads DUMP_CHUNK rows at a time and gzips them into a temporary file, kept in memory up to DUMP_SPOOL bytes.
+#   a part is cut once it's within DUMP_SLACK of the upload limit (gzip holds some back until it's closed), or at half
+#   the limit if that's less than DUMP_SLACK.
+#   *importdump writes DUMP_BATCH rows per transaction. in a big db each transaction rewrites pages all over the
+#   indexes, so fewer is much faster, but live stars wait for each one to be written
+DUMP_CHUNK = 1000
+DUMP_SPOOL = 1<<20
+DUMP_SLACK = 1<<20
+DUMP_BATCH = 5000
+# what a dump has of each table. ord and author_ord are left out, the triggers number them again when importing
+DUMP_COLUMNS = {"awarded": ("msg","msg_sb","msg_ch","guild","author"), "stars": ("starrer","msg","guild","medium")}
+CSV_COLUMNS = ("table","msg","guild","msg_sb","msg_ch","author","starrer","medium")
+
+# stars (starrer -> medium) to the starrers and mediums blobs in packed, and back. starrers are little endian
+def pack(stars:dict[int,int]) -> tuple[bytes,bytes]:
+    starrers = array.array("Q", stars.keys())
+    if sys.byteorder == "big": starrers.byteswap()
+    return starrers.tobytes(), bytes(stars.values())
+
+def unpack(starrers:bytes, mediums:bytes) -> dict[int,int]:
+    ids = array.array("Q", starrers)
+    if sys.byteorder == "big": ids.byteswap()
+    return dict(zip(ids, mediums))
+
+class DumpWriter:
+    """rows of DUMP_COLUMNS as gzipped jsonl or csv (one table column for all of them), cut into parts of less than
+    `limit` bytes. each part is a whole gzip file of its own, so they can be read separately. `write` and `close` give
+    back the parts that are done, as files at position 0 for the caller to close. these block, run them in a thread"""
+
+    def __init__(self, fmt:Literal["jsonl","csv"], limit:int) -> None:
+        self.fmt, self.limit = fmt, limit
+        self.cut = max(limit - DUMP_SLACK, limit // 2)  # a small limit would make every row a part of its own
+        self.raw = self.gz = self.text = self.csv = None
+
+    def start(self) -> None:
+        self.raw = tempfile.SpooledTemporaryFile(DUMP_SPOOL)
+        self.gz = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        self.text = io.TextIOWrapper(self.gz, encoding="utf-8", newline="")
+        if self.fmt == "csv":
+            self.csv = csv.writer(self.text)
+            self.csv.writerow(CSV_COLUMNS)
+
+    def write(self, table:str, rows:list[tuple]) -> list[tempfile.SpooledTemporaryFile]:
+        done = []
+        for row in rows:
+            if self.raw is None: self.start()
+            record = dict(zip(DUMP_COLUMNS[table], row))
+            if self.fmt == "csv": self.csv.writerow([table, *(record.get(c, "") for c in CSV_COLUMNS[1:])])
+            else:                 self.text.write(json.dumps({"table":table} | record) + "\n")
+            if self.raw.tell() > self.cut: done.append(self.close())
+        return done
+
+    def close(self) -> tempfile.SpooledTemporaryFile|None:
+        if self.raw is None: return None
+        self.text.close()  # closes gz too, which writes the rest. raw stays open
+        raw, self.raw = self.raw, None
+        raw.seek(0)
+        return raw
+
+# the other way around: (table, row) for every row in a part made by DumpWriter. raises ValueError if it's not one
+def read_dump(fp:io.BufferedIOBase, fmt:Literal["jsonl","csv"]) -> Iterator[tuple[str,tuple]]:
+    try:
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=fp, mode="rb"), encoding="utf-8", newline="") as text:
+            for record in (csv.DictReader(text) if fmt == "csv" else map(json.loads, text)):
+                table = record["table"]
+                yield table, tuple(int(record[c]) for c in DUMP_COLUMNS[table])
+    except (KeyError, TypeError, UnicodeDecodeError, EOFError, gzip.BadGzipFile, csv.Error) as e:
+        raise ValueError(f"{type(e).__name__}: {e}") from e
 
 def calc_color(count:int) -> discord.Colour:
     return discord.Colour.from_rgb(255, 255, max(0,min(255,1024//(count+3)-20)))
@@ -61,34 +301,377 @@ def on_time(msg_id:int, timeout_d:int|None) -> bool:
     send_time = discord.utils.snowflake_time(msg_id)
     return datetime.datetime.now(datetime.UTC) < send_time + datetime.timedelta(days=timeout_d)
 
-def short_disp(msg:discord.Message, escape=False) -> str:  # used for the *top messages and also replies in starboard
-    return ( ("[forwarding]" if msg.flags.value & FLAG_FORWARDED else "[replying] ")*(msg.reference is not None)
-           + (discord.utils.escape_markdown(msg.system_content.replace("\n"," ")) if escape else msg.system_content)
+@dataclass(slots=True)
+class Snapshot:
+    """the parts of a message that `build_message` and `short_disp` need. it's what the message cache keeps, instead of
+    the whole message."""
+    id: int
+    channel_id: int
+    jump_url: str
+    author_id: int
+    author_name: str
+    avatar_url: str
+    content: str  # system_content
+    created_at: datetime.datetime
+    edited_at: datetime.datetime|None
+    attachments: list[str]  # urls
+    stickers: int
+    poll: bool
+    forwarded: bool
+    replying: bool  # has a reference, even if we don't have the message
+    reply: "Snapshot|None" = None  # the referenced message, if discord gave it to us
+
+    @classmethod
+    def of(cls, msg:discord.Message, reply:bool=True) -> "Snapshot":
+        resolved = msg.reference and msg.reference.resolved
+        return cls(msg.id, msg.channel.id, msg.jump_url, msg.author.id, msg.author.display_name,
+                   msg.author.display_avatar.url, msg.system_content, msg.created_at, msg.edited_at,
+                   [att.url for att in msg.attachments], len(msg.stickers), msg.poll is not None,
+                   bool(msg.flags.value & FLAG_FORWARDED), msg.reference is not None,
+                   cls.of(resolved, reply=False) if reply and isinstance(resolved, discord.Message) else None)
+
+def short_disp(msg:Snapshot, escape=False) -> str:  # used for the *top messages and also replies in starboard
+    return ( ("[forwarding]" if msg.forwarded else "[replying] ")*msg.replying
+           + (discord.utils.escape_markdown(msg.content.replace("\n"," ")) if escape else msg.content)
            + " [attachment]"*len(msg.attachments)
-           + " [sticker]"*len(msg.stickers)
-           + " [poll]"*(msg.poll is not None)
+           + " [sticker]"*msg.stickers
+           + " [poll]"*msg.poll
            + " [edited]"*(msg.edited_at is not None))
 
+# everything `build_message` puts in a starboard message. most stars don't change it (the colour stops changing at ~47
+#   stars and the emoji at 20), and then there's no point in editing
+def fingerprint(payload:dict, msg:Snapshot) -> int:
+    e: discord.Embed = payload["embed"]
+    return hash((payload["content"], e.colour, e.description, e.image.url, e.footer.text, e.author.name,
+                 e.author.icon_url, tuple((f.name,f.value,f.inline) for f in e.fields), msg.edited_at))
+
 def msg_fields(msg: discord.Message) -> dict:
-    return { "msg_id":msg.id, "msg_ch_id":msg.channel.id, "author_id":msg.author.id, "msg":msg }
+    return { "msg_id":msg.id, "msg_ch_id":msg.channel.id, "author_id":msg.author.id, "msg":Snapshot.of(msg) }
 
 class NotConfigured(Exception): pass
 
+class LRU:
+    """a dict that forgets the least recently used keys once it has more than `maxsize`, and (if given a `ttl`) keys
+    that were set more than `ttl` seconds ago."""
+
+    def __init__(self, maxsize:int, ttl:float|None=None) -> None:
+        self.maxsize, self.ttl = maxsize, ttl
+        self.data: OrderedDict = OrderedDict()  # key -> (value, expiry time)
+        self.stats = {"hits":0, "misses":0, "evictions":0, "expired":0}
+
+    def get(self, key, default=None):
+        match self.data.get(key):
+            case None:
+                self.stats["misses"] += 1
+                return default
+            case _, expiry if expiry is not None and expiry < time.monotonic():
+                self.stats["misses"] += 1
+                self.stats["expired"] += 1
+                del self.data[key]
+                return default
+            case value, _:
+                self.stats["hits"] += 1
+                self.data.move_to_end(key)
+                return value
+
+    def __setitem__(self, key, value) -> None:
+        self.data[key] = value, self.ttl and time.monotonic() + self.ttl
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, (default,))[0]
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+@dataclass
+class PendingEdit:
+    sb_id: int
+    count: int
+    msg: Snapshot
+    first: float  # loop time of the first and last star since the last edit
+    last: float
+    task: asyncio.Task|None = None
+
+class GroupCommit:
+    """commits the writes of many handlers at once. writes go through `execute`, and then `commit` returns once they
+    are committed, together with whatever else got written in the meantime. `lock` keeps the transaction to yourself
+    (what starconfig needs so it can roll back without taking stars with it).
+    a handler that wrote commits before calling discord: with `database.SHARED`, the open transaction has the whole
+    file's write lock, and a call can take longer than the other processes' busy_timeout."""
+
+    def __init__(self, db:aiosqlite.Connection, interval:float=COMMIT_INTERVAL, batch:int=COMMIT_BATCH) -> None:
+        self.db = db
+        self.interval, self.batch = interval, batch
+        self.lock = asyncio.Lock()
+        self.waiting: list[asyncio.Future] = []
+        self.full = asyncio.Event()
+        self.task: asyncio.Task|None = None
+        self.stats = {"commits":0, "waited":0}  # waited = commit() calls, so waited/commits is the batch size
+
+    async def execute(self, sql:str, parameters=()) -> aiosqlite.Cursor:
+        async with self.lock:
+            return await self.db.execute(sql, parameters)
+
+    async def executemany(self, sql:str, parameters) -> aiosqlite.Cursor:
+        async with self.lock:
+            return await self.db.executemany(sql, parameters)
+
+    # now=True commits without waiting for others to join, for bulk writes that are a big batch by themselves, and
+    #   for a handler about to call discord (that would only add to the wait)
+    async def commit(self, now:bool=False) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        self.waiting.append(fut)
+        self.stats["waited"] += 1
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        if now or len(self.waiting) >= self.batch:
+            self.full.set()
+        await fut
+
+    async def run(self) -> None:
+        try: await asyncio.wait_for(self.full.wait(), self.interval)
+        except TimeoutError: pass
+        self.full.clear()
+        self.task = None  # whoever comes now waits for the next one
+        waiting, self.waiting = self.waiting, []
+        try:
+            async with self.lock:
+                await self.db.commit()
+            self.stats["commits"] += 1
+        except Exception as exc:
+            for fut in waiting: fut.set_exception(exc)
+        else:
+            for fut in waiting: fut.set_result(None)
+
+class BloomFilter:
+    """a set of ints that can't forget. `x in f` is always True if x was added, and only True for `fpr` of the rest,
+    as long as there are fewer than `capacity` of them. takes ~1.2 bytes per item at 1%."""
+
+    def __init__(self, capacity:int, fpr:float=TRACKED_FPR) -> None:
+        self.capacity, self.fpr, self.count = capacity, fpr, 0
+        self.m = max(64, math.ceil(-capacity * math.log(fpr) / math.log(2)**2))  # bits
+        self.k = max(1, round(self.m / capacity * math.log(2)))  # hashes per item
+        self.bits = bytearray((self.m+7) // 8)
+
+    def positions(self, x:int):
+        # splitmix64, and then double hashing with the two halves
+        z = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        z ^= z >> 31
+        h1, h2 = z & 0xFFFFFFFF, z >> 32 | 1
+        return ((h1 + i*h2) % self.m for i in range(self.k))
+
+    def add(self, x:int) -> None:  # only counts it if it sets a bit. if it doesn't, it's as good as in already
+        new = False
+        for i in self.positions(x):
+            if not self.bits[i >> 3] & 1 << (i & 7):
+                self.bits[i >> 3] |= 1 << (i & 7)
+                new = True
+        self.count += new
+
+    def __contains__(self, x:int) -> bool:
+        return all(self.bits[i >> 3] & 1 << (i & 7) for i in self.positions(x))
+
+    def stats(self) -> dict:
+        return {"items":self.count, "capacity":self.capacity, "bytes":len(self.bits), "hashes":self.k,
+                "fpr":(1 - math.exp(-self.k * self.count / self.m)) ** self.k}  # expected, at the current count
+
+class KeyedLock:
+    """a lock per key. `async with locks(key)` waits for whoever has that key (in order), other keys go on in parallel.
+    locks are forgotten when nobody holds or waits for them."""
+
+    def __init__(self) -> None:
+        self.locks: dict[int, list] = {}  # key -> [lock, holders and waiters]
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, key:int):
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0: del self.locks[key]
+
+class EditScheduler:
+    """keeps the latest star count of every starboard message that needs to be edited, and edits each one once the stars
+    quiet down. awards (inside `sending`) go before any edit, and `cancel` drops the edit of a message being deleted."""
+
+    def __init__(self, edit:Callable[[int,int,int,Snapshot], Awaitable[bool]],
+                 quiet:float=EDIT_QUIET, max_delay:float=EDIT_MAX_DELAY) -> None:
+        self.edit = edit  # (sb_id, msg_sb_id, count, msg), does the actual edit. False if there was nothing to change
+        self.quiet, self.max_delay = quiet, max_delay
+        self.pending: dict[int, PendingEdit] = {}  # by msg_sb_id
+        self.tasks: set[asyncio.Task] = set()  # strong references, until they're done
+        self.sends = 0
+        self.no_sends = asyncio.Event()
+        self.no_sends.set()
+        # scheduled = edits asked for, coalesced = of those, the ones folded into an edit that was already pending,
+        #   edited = edits actually sent, unchanged = skipped because the message would look the same,
+        #   cancelled = dropped because the message was unawarded
+        self.stats = {"scheduled":0, "coalesced":0, "edited":0, "unchanged":0, "cancelled":0}
+
+    def schedule(self, sb_id:int, msg_sb_id:int, count:int, msg:Snapshot) -> None:
+        self.stats["scheduled"] += 1
+        now = asyncio.get_running_loop().time()
+        if (p := self.pending.get(msg_sb_id)) is not None:
+            self.stats["coalesced"] += 1
+            p.sb_id, p.count, p.msg, p.last = sb_id, count, msg, now
+        else:
+            self.pending[msg_sb_id] = p = PendingEdit(sb_id, count, msg, now, now)
+            p.task = asyncio.create_task(self.run(msg_sb_id, p))
+            self.tasks.add(p.task)
+            p.task.add_done_callback(self.tasks.discard)
+
+    async def run(self, msg_sb_id:int, p:PendingEdit) -> None:
+        loop = asyncio.get_running_loop()
+        while (delay := min(p.last+self.quiet, p.first+self.max_delay) - loop.time()) > 0:
+            await asyncio.sleep(delay)
+        await self.no_sends.wait()
+        del self.pending[msg_sb_id]  # stars from now on get a new edit
+        await self.flush(msg_sb_id, p)
+
+    async def flush(self, msg_sb_id:int, p:PendingEdit) -> None:
+        try:
+            self.stats["edited" if await self.edit(p.sb_id, msg_sb_id, p.count, p.msg) else "unchanged"] += 1
+        except Exception as exc:
+            logging.exception("couldn't edit starboard message", exc_info=exc)
+
+    def cancel(self, msg_sb_id:int) -> None:
+        if (p := self.pending.pop(msg_sb_id, None)) is not None:
+            self.stats["cancelled"] += 1
+            p.task.cancel()
+
+    async def drain(self) -> None:  # do every pending edit right now (on unload)
+        pending, self.pending = self.pending, {}
+        for p in pending.values(): p.task.cancel()
+        await asyncio.gather(*(self.flush(msg_sb_id, p) for msg_sb_id,p in pending.items()))
+
+    @contextlib.asynccontextmanager
+    async def sending(self):
+        self.sends += 1
+        self.no_sends.clear()
+        try:
+            yield
+        finally:
+            self.sends -= 1
+            if self.sends == 0: self.no_sends.set()
+
 class Starboard(commands.Cog):
 
     def __init__(self, bot:commands.Bot) -> None:
         self.bot: commands.Bot = bot
         self.db: aiosqlite.Connection = bot.db  # shortcut :3
+        self.reader: database.ReadPool = bot.reader  # for the user commands. see `read_fetchone`
+        self.peers: ipc.Peers = bot.peers  # the other processes sharing the db, if any. see `on_peer_message`
+        self.committer = GroupCommit(self.db)  # writes go through here, see `GroupCommit`
+        self.locks = KeyedLock()  # by original message id, see `starring`
+        # copy of the guilds table (guild -> minimum,sb,timeout), loaded in `cog_load` and refreshed by `load_guild`
+        #   every time starconfig commits or rolls back. a guild that isn't here is not configured, no need to ask db
+        self.guilds: dict[int, tuple[int,int,int|None]] = {}
+        # `channel_allowed` verdicts by channel id, along with the parent channel for threads (None for channels).
+        #   forgotten when a channel or thread changes (see `forget_channel`), or when it's the least recently asked
+        #   about of VERDICTS_SIZE
+        self.verdicts = LRU(VERDICTS_SIZE)
+        self.edits = EditScheduler(self.edit_sb)
+        self.rendered = LRU(RENDERED_SIZE)  # msg_sb_id -> `fingerprint` of what we last sent there
+        self.messages = LRU(MESSAGES_SIZE, MESSAGES_TTL)  # msg_id -> Snapshot, see `fetch_msg_opt`
+        self.ranking: dict[int, int] = {}  # guild -> how many times its stars changed. see `rerank`
+        self.pages = LRU(PAGES_SIZE, PAGES_TTL)  # (guild,window,author,page) -> ranking version, rows, embed. see `top`
+        # every message with stars or in awarded, and every starboard message. most deleted messages were never starred,
+        #   and this lets us ignore them without asking the db. made in `load_tracked`, added to by `track`. stays a
+        #   superset of what's in the db, since we never remove anything from it
+        self.tracked = BloomFilter(TRACKED_MIN)
+        self.tracking: list[int]|None = None  # tracked while `load_tracked` is reading the db, see `retrack`
+        self.retracking: asyncio.Task|None = None
+        # guilds whose missed reactions were caught up on since we last connected. only these get their watermark moved
+        self.reconciled: set[int] = set()
+        self.connected = False
+        self.reconciling: asyncio.Task|None = None
+        self.watermarking: asyncio.Task|None = None
+        self.sweeping: asyncio.Task|None = None
         # yes you need to register these manually
         self.bot.tree.add_command(app_commands.ContextMenu(name="⭐ Star",  callback=self.star_menu  ), override=True)
         self.bot.tree.add_command(app_commands.ContextMenu(name="⭐ Unstar",callback=self.unstar_menu), override=True)
 
+    # what `*perf` and the prometheus file show of the cog's own stats
+    def perf_sources(self) -> dict:
+        return {"edits":    lambda: self.edits.stats,
+                "group":    lambda: self.committer.stats,
+                "tracked":  lambda: self.tracked.stats(),
+                "messages": lambda: self.messages.stats | {"size":len(self.messages)},
+                "rendered": lambda: self.rendered.stats | {"size":len(self.rendered)},
+                "pages":    lambda: self.pages.stats | {"size":len(self.pages)},
+                "verdicts": lambda: self.verdicts.stats | {"size":len(self.verdicts)}}
+
+    async def cog_load(self) -> None:
+        for name, read in self.perf_sources().items(): perf.metrics.source(name, read)
+        self.guilds = {guild_id:(minimum,sb_id,timeout_d) async for guild_id,minimum,sb_id,timeout_d in
+                       await self.db.execute("SELECT guild,minimum,sb,timeout FROM guilds")}
+        await self.retrack()
+        self.sweeping = asyncio.create_task(self.sweep())
+
+    async def cog_unload(self) -> None:
+        for name in self.perf_sources(): perf.metrics.source(name, None)
+        for task in (self.reconciling, self.watermarking, self.sweeping, self.retracking):
+            if task is not None: task.cancel()
+        await self.edits.drain()
+        await self.reader.close()
+
     ### HELPERS
 
+    # whether this process has the guild's shard (discord's formula). always when we're not sharded or all the shards
+    #   are here. the background work (packing, catching up) is only done for these, other processes do the rest
+    def ours(self, guild_id:int) -> bool:
+        match getattr(self.bot, "shard_ids", None):
+            case None:      return True
+            case shard_ids: return (guild_id >> 22) % self.bot.shard_count in shard_ids
+
+    # starts making `tracked` again from the db, with room for what's there now. ids tracked until it's done go in
+    #   `tracking` too, and it adds them at the end
+    def retrack(self) -> asyncio.Task:
+        self.tracking = []
+        self.retracking = asyncio.create_task(self.load_tracked())
+        return self.retracking
+
+    async def load_tracked(self) -> None:
+        # ids tracked before `retrack` aren't in `tracking`, but their inserts were already waiting for the lock (see
+        #   `track`), and it's first come first served. once we get it they're written, and once committed the read
+        #   pool sees them. the read connection is ours alone, so reading it bit by bit doesn't get in anyone's way
+        async with self.committer.lock: pass
+        await self.committer.commit()
+        async with self.reader() as db:
+            (n,), = await db.execute_fetchall(
+                "SELECT (SELECT count(*) FROM counts) + 2*(SELECT count(*) FROM awarded)")
+            tracked = BloomFilter(max(2*n, TRACKED_MIN))
+            cur = await db.execute("SELECT msg FROM counts UNION ALL SELECT msg FROM awarded "
+                                   "UNION ALL SELECT msg_sb FROM awarded")
+            while rows := await cur.fetchmany(10000):
+                for x, in rows: tracked.add(x)
+            await cur.close()
+        for x in self.tracking: tracked.add(x)
+        self.tracked, self.tracking = tracked, None
+        logging.info("tracking messages: %s", tracked.stats())
+
+    # call right before inserting any of these into stars or awarded, with nothing else awaited in between but the
+    #   committer's lock (`load_tracked` counts on that)
+    def track(self, *ids:int) -> None:
+        for x in ids: self.tracked.add(x)
+        if self.tracking is not None:
+            self.tracking.extend(ids)
+        elif self.tracked.count > self.tracked.capacity:  # past this it gets worse fast
+            self.retrack()
+
     # get the channel properly (because archived threads are not kept in cache)
     async def get_channel(self, guild_id:int, channel_id:int) -> discord.TextChannel:
         match self.bot.get_channel(channel_id):
-            case None: return await self.bot.get_guild(guild).fetch_channel(channel_id)
+            case None: return await self.bot.get_guild(guild_id).fetch_channel(channel_id)
             case x:    return x
 
     def partial_msg(self, channel:int, id:int) -> discord.PartialMessage:
@@ -96,57 +679,147 @@ class Starboard(commands.Cog):
     async def fetch_msg(self, channel:int, id:int) -> discord.Message:
         return await self.partial_msg(channel,id).fetch()
 
-    # only intended for starred messages, to handle message disappearance. but it will do nothing to other messages
-    async def fetch_msg_opt(self, msg_ch_id:int, msg_id:int):
+    # only intended for starred messages, to handle message disappearance. but it will do nothing to other messages.
+    #   goes through `messages`, which edits and deletes keep up to date. call it with the message's lock, and commit
+    #   after (a gone message is forgotten in here). with commit=True, what was written before is committed if it
+    #   has to be fetched (see `GroupCommit`)
+    async def fetch_msg_opt(self, msg_ch_id:int, msg_id:int, forget:bool=True, commit:bool=False) -> Snapshot|None:
+        if (msg := self.messages.get(msg_id)) is not None: return msg
+        if commit: await self.committer.commit(now=True)
         try:
-            return await self.fetch_msg(msg_ch_id,msg_id)
+            self.messages[msg_id] = msg = Snapshot.of(await self.fetch_msg(msg_ch_id,msg_id))
+            return msg
         except (discord.NotFound, discord.Forbidden):
-            await self.forget_message(msg_id)
+            if forget: await self.forget_message(msg_id)
             return None
 
-    async def db_fetchone(self, sql, parameters) -> tuple|None:  # avoids annoying double await
-        return await (await self.db.execute(sql, parameters)).fetchone()
+    # same, for commands. they don't have the lock, so the fetch is done without it (no need to make the stars wait)
+    #   and a gone message is forgotten with it
+    async def show_msg_opt(self, msg_ch_id:int, msg_id:int) -> Snapshot|None:
+        if (msg := await self.fetch_msg_opt(msg_ch_id, msg_id, forget=False)) is None:
+            async with self.locks(msg_id): await self.forget_message(msg_id)
+            await self.committer.commit()
+        return msg
+
+    # reads on self.db go through execute_fetchall, which reads to the end in the db thread. a cursor half read keeps
+    #   its statement open, and so an old snapshot of the db: the next write (queued meanwhile by some other listener)
+    #   has to start a transaction from it, and if another process wrote since then it fails right away with BUSY
+    #   (on `db` if given, the writer otherwise. that's also one trip to the db thread instead of two)
+    async def db_fetchone(self, sql, parameters, db:aiosqlite.Connection|None=None) -> tuple|None:
+        rows = await (db or self.db).execute_fetchall(sql, parameters)
+        return rows[0] if rows else None
+
+    # same, but on a read connection. doesn't wait for the writer, and doesn't see what it hasn't committed yet. a
+    #   command that reads more than once borrows one with `self.reader()` instead, and passes it to `db_fetchone`
+    async def read_fetchone(self, sql, parameters) -> tuple|None:
+        async with self.reader() as db:
+            return await self.db_fetchone(sql, parameters, db)
+    async def read_fetchall(self, sql, parameters) -> list[tuple]:
+        async with self.reader() as db:
+            return await db.execute_fetchall(sql, parameters)
 
+    async def star_count(self, msg_id:int, read:bool=False) -> int:
+        fetchone = self.read_fetchone if read else self.db_fetchone
+        match await fetchone("SELECT count FROM counts WHERE msg=?", (msg_id,)):
+            case None:   return 0
+            case count,: return count
+
+    # threads go by their parent's name. the answer is cached, so (archived) threads don't get fetched every star
     async def channel_allowed(self, guild_id:int, ch_id:int) -> bool:
+        match self.verdicts.get(ch_id):
+            case allowed, _: return allowed
         ch = await self.get_channel(guild_id, ch_id)
         if isinstance(ch, discord.Thread):
-            ch = ch.parent
-        return re.search(r"\bcw\b", ch.name) is None
+            allowed = await self.channel_allowed(guild_id, ch.parent_id)
+            self.verdicts[ch_id] = allowed, ch.parent_id
+        else:
+            allowed = re.search(r"\bcw\b", ch.name) is None
+            self.verdicts[ch_id] = allowed, None
+        return allowed
+
+    def forget_channel(self, ch_id:int) -> None:  # also forgets the threads in it
+        self.verdicts.pop(ch_id)
+        for thread_id in [k for k,((_,parent_id),_) in self.verdicts.data.items() if parent_id == ch_id]:
+            self.verdicts.pop(thread_id)
+
+    # a *top page rendered before this is out of date. if `content` is set, an awarded message itself changed, so
+    #   pages showing the same messages aren't good either
+    def rerank(self, guild_id:int|None, content:bool=False) -> None:
+        self.ranking[guild_id] = self.ranking.get(guild_id, 0) + 1
+        if content:
+            for key in [key for key in self.pages.data if key[0] == guild_id]: self.pages.pop(key)
 
     # builds a message for starboard. given in this funny way so it can be unpacked into edit/send
-    async def build_message(self, count:int, msg:discord.Message) -> dict:
-        embed = discord.Embed(colour=calc_color(count), description=msg.system_content, timestamp=msg.created_at)
+    async def build_message(self, count:int, msg:Snapshot) -> dict:
+        embed = discord.Embed(colour=calc_color(count), description=msg.content, timestamp=msg.created_at)
         att_no = len(msg.attachments)
-        if att_no>0: embed.set_image(url=msg.attachments[0].url)
+        if att_no>0: embed.set_image(url=msg.attachments[0])
         if att_no>1: embed.set_footer(text=f"{att_no-1} attachment{'s are' if att_no!=2 else ' is'} not being shown")
-        embed.set_author(name=msg.author.display_name, icon_url=msg.author.display_avatar.url)
-        if msg.reference is not None:
-            start = "forward" if msg.flags.value & FLAG_FORWARDED else "reply"
-            match msg.reference.resolved:
-                case discord.DeletedReferencedMessage | None:
+        embed.set_author(name=msg.author_name, icon_url=msg.avatar_url)
+        if msg.replying:
+            start = "forward" if msg.forwarded else "reply"
+            match msg.reply:
+                case None:  # deleted, or discord didn't send it
                     embed.add_field(name=start+"ing to some message", value="sorry")
                 case reply:
-                    embed.add_field(name=start+"ing to "+reply.author.display_name, value=short_disp(reply), inline=False)
+                    embed.add_field(name=start+"ing to "+reply.author_name, value=short_disp(reply), inline=False)
                     if att_no==0 and len(reply.attachments)>0:
-                        embed.set_image(url=reply.attachments[0].url).set_footer(text="attachment shown is from "+start)
+                        embed.set_image(url=reply.attachments[0]).set_footer(text="attachment shown is from "+start)
         return { "content":"⭐🌟💫🤩🌌"[min(4,count//5)]+" "+msg.jump_url, "embed":embed }
 
+    async def edit_sb(self, sb_id:int, msg_sb_id:int, count:int, msg:Snapshot) -> bool:  # see `EditScheduler`
+        payload = await self.build_message(count, msg)
+        if self.rendered.get(msg_sb_id) == (fp := fingerprint(payload, msg)): return False
+        try: await self.partial_msg(sb_id,msg_sb_id).edit(**payload)
+        except (discord.Forbidden, discord.NotFound): pass  # if the message was deleted, or on migration
+        self.rendered[msg_sb_id] = fp
+        return True
+
+    async def send_sb(self, sb_id:int, count:int, msg:Snapshot) -> discord.Message:
+        payload = await self.build_message(count, msg)
+        async with self.edits.sending():
+            msg_sb = await self.bot.get_partial_messageable(sb_id).send(**payload)
+        self.rendered[msg_sb.id] = fingerprint(payload, msg)
+        return msg_sb
+
     async def forget_message(self, msg_id:int, **r):
-        if (await self.db.execute("DELETE FROM stars WHERE msg=?", (msg_id,))).rowcount != 0:
+        if ((await self.committer.execute("DELETE FROM stars WHERE msg=?", (msg_id,))).rowcount
+          + (await self.committer.execute("DELETE FROM packed WHERE msg=?", (msg_id,))).rowcount) != 0:
             await self.unaward(msg_id, **r)
 
     # does nothing if the message wasn't awarded
     async def unaward(self, msg_id:int, sb_id:int|None=None, **_):
         match await self.db_fetchone("SELECT msg_sb,guild FROM awarded WHERE msg=?", (msg_id,)):
             case msg_sb_id, guild_id:
-                await self.db.execute("DELETE FROM awarded WHERE msg=?", (msg_id,))
+                await self.committer.execute("DELETE FROM awarded WHERE msg=?", (msg_id,))
+                self.edits.cancel(msg_sb_id)
+                self.rendered.pop(msg_sb_id)
+                await self.committer.commit(now=True)  # before the delete, see `GroupCommit`
                 try:
-                    if sb_id is not None:
-                        sb_id, = await self.db_fetchone("SELECT sb FROM guilds WHERE guild=?", (guild_id,))
+                    if sb_id is None:
+                        _, sb_id, _ = self.guilds[guild_id]
                     # huh. this is problematic if sb changes
                     await self.partial_msg(sb_id,msg_sb_id).delete()
                 except discord.Forbidden: pass
 
+    # deletes many starboard messages in as few requests as we can. discord only bulk deletes messages up to 14 days old
+    async def delete_sb(self, sb_id:int, msg_sb_ids:list[int]) -> None:
+        cutoff = discord.utils.time_snowflake(discord.utils.utcnow() - datetime.timedelta(days=14, minutes=-5))
+        single = [x for x in msg_sb_ids if x <= cutoff]
+        young = [x for x in msg_sb_ids if x > cutoff]
+        if (sb := self.bot.get_channel(sb_id)) is None: single += young
+        else:
+            for i in range(0, len(young), 100):
+                try: await sb.delete_messages([discord.Object(x) for x in young[i:i+100]])
+                except discord.Forbidden: pass
+                except discord.HTTPException: single += young[i:i+100]  # one of them is gone already, probably
+        limit = asyncio.Semaphore(SB_DELETES)
+        async def delete(msg_sb_id:int) -> None:
+            async with limit:
+                try: await self.partial_msg(sb_id,msg_sb_id).delete()
+                except (discord.Forbidden, discord.NotFound): pass
+        await asyncio.gather(*map(delete, single))
+
     ### STARRING
     # can work with reactions (`on_raw_reaction_{add,remove}`, "raw" in case someone stars older messages)
     #     or the pop up menu (`{,un}star_menu`, added in `__main__`).
@@ -163,33 +836,42 @@ class Starboard(commands.Cog):
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, ev:discord.RawReactionActionEvent):
         if ev.emoji.name != "⭐": return
-        r  = await self.get_guild_info(ev.guild_id)
+        r  = self.get_guild_info(ev.guild_id)
         r |= await self.find_msg(msg_id=ev.message_id, msg_ch_id=ev.channel_id, author_id=ev.message_author_id, **r)
-        if "ok" != await self.add_star(user_id=ev.user_id, **r):
+        if "ok" != await self.starring(self.add_star, user_id=ev.user_id, **r):
             # something happened. delete it and forget
             await self.partial_msg(ev.channel_id,ev.message_id).remove_reaction("⭐", discord.Object(ev.user_id))
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, ev:discord.RawReactionActionEvent):
         if ev.emoji.name != "⭐": return
-        r  = await self.get_guild_info(ev.guild_id)
+        r  = self.get_guild_info(ev.guild_id)
         r |= await self.find_msg(msg_id=ev.message_id, msg_ch_id=ev.channel_id, author_id=ev.message_author_id, **r)
-        await self.remove_star(user_id=ev.user_id, **r)
+        await self.starring(self.remove_star, user_id=ev.user_id, **r)
 
     async def star_menu(self, c:discord.Interaction, msg:discord.Message):
-        r  = await self.get_guild_info(c.guild_id)
+        r  = self.get_guild_info(c.guild_id)
         r |= await self.find_msg(**msg_fields(msg), **r) | {"medium":FROM_MENU}
-        txt = await self.add_star(user_id=c.user.id, **r)
+        txt = await self.starring(self.add_star, user_id=c.user.id, **r)
         await c.response.send_message(txt, ephemeral=True)
 
     async def unstar_menu(self, c:discord.Interaction, msg:discord.Message):
-        r  = await self.get_guild_info(c.guild_id)
+        r  = self.get_guild_info(c.guild_id)
         r |= await self.find_msg(**msg_fields(msg), **r) | {"medium":FROM_MENU}
-        txt = await self.remove_star(user_id=c.user.id, **r)
+        txt = await self.starring(self.remove_star, user_id=c.user.id, **r)
         await c.response.send_message(txt, ephemeral=True)
 
-    async def get_guild_info(self, guild_id:int) -> dict:
-        match await self.db_fetchone("SELECT minimum,sb,timeout FROM guilds WHERE guild=?", (guild_id,)):
+    # does add_star/remove_star with the message locked, so that two stars at once can't both award it, or an unstar
+    #   finish before the star it undoes. other messages go on in parallel. the commit waits outside of the lock
+    async def starring(self, f:Callable[..., Awaitable[str]], **r) -> str:
+        async with self.locks(r["msg_id"]):
+            txt = await f(**r)
+            self.rerank(r["guild_id"])
+        await self.committer.commit()
+        return txt
+
+    def get_guild_info(self, guild_id:int) -> dict:
+        match self.guilds.get(guild_id):
             case None: raise NotConfigured()
             case minimum,sb_id,timeout_d:
                 return {"minimum":minimum, "sb_id":sb_id, "timeout_d":timeout_d, "guild_id":guild_id}
@@ -198,7 +880,7 @@ class Starboard(commands.Cog):
     # set medium to FROM_REACT_SB if this happened. the menu functions ignore this, overriding it with medium=FROM_MENU,
     #   because we don't need to keep track where the user right clicked.
     async def find_msg(self, minimum:int, sb_id:int, msg_id:int, msg_ch_id:int, guild_id:int, author_id:int,
-                       msg:discord.Message|None=None, **_) -> dict:  # <- useless type annotation
+                       msg:Snapshot|None=None, **_) -> dict:  # <- useless type annotation
         medium = FROM_REACT
         if msg_ch_id == sb_id:
             try:
@@ -210,80 +892,310 @@ class Starboard(commands.Cog):
         return {"msg_id":msg_id, "msg_ch_id":msg_ch_id, "author_id":author_id, "medium":medium, "msg":msg}
 
     async def add_star(self, minimum:int, sb_id:int, timeout_d:int|None, msg_id:int, msg_ch_id:int, guild_id:int,
-                       author_id:int, user_id:int, medium:int, msg:discord.Message|None=None) -> str:
+                       author_id:int, user_id:int, medium:int, msg:Snapshot|None=None) -> str:
         if user_id == author_id: return "rule 11"
         if not await self.channel_allowed(guild_id, msg_ch_id): return "no starring in cw channels. sorry!"
-        if (await self.db.execute("INSERT OR IGNORE INTO stars(starrer,msg,guild,medium) VALUES(?,?,?,?)",
-                                  (user_id,msg_id,guild_id,medium))).rowcount == 0:  # try to add star
+        self.track(msg_id)
+        if (await self.committer.execute("INSERT OR IGNORE INTO stars(starrer,msg,guild,medium) VALUES(?,?,?,?)",
+                                         (user_id,msg_id,guild_id,medium))).rowcount == 0:  # try to add star
             return "you already starred that, bozo!"  # if the star was there already (when above query fails UNIQUE)
-        count, = await self.db_fetchone("SELECT count(*) FROM stars WHERE msg=?", (msg_id,))
-        if count >= minimum:
-            msg = msg or await self.fetch_msg_opt(msg_ch_id,msg_id)
-            if msg is None: return "this message never existed. no clue what you are talking about"
-            match await self.db_fetchone("SELECT msg_sb FROM awarded WHERE msg=?", (msg_id,)):
-                case msg_sb_id,:  # already in starboard, edit the message
-                    try: await self.partial_msg(sb_id,msg_sb_id).edit(**await self.build_message(count, msg))
-                    except discord.Forbidden: pass  # if the message was deleted, or on migration
-                case None if on_time(msg_id,timeout_d):
-                    # not in starboard yet (usually bc count==minimum, or minimum was higher back then)
-                    msg_sb = await self.bot.get_partial_messageable(sb_id).send(**await self.build_message(count, msg))
-                    await self.db.execute("INSERT INTO awarded(msg,msg_sb,msg_ch,guild,author) VALUES(?,?,?,?,?)",
-                                        (msg_id, msg_sb.id, msg_ch_id, guild_id, msg.author.id))
-        await self.db.commit()
-        return "ok"
+        # or if it was packed (see `pack_message`). the UNIQUE doesn't know about those
+        count, starrers, mediums = await self.db_fetchone(
+            "SELECT count,starrers,mediums FROM counts LEFT JOIN packed USING(msg) WHERE counts.msg=?", (msg_id,))
+        if starrers is not None and user_id in unpack(starrers, mediums):
+            await self.committer.execute("DELETE FROM stars WHERE starrer=? AND msg=?", (user_id,msg_id))
+            return "you already starred that, bozo!"
+        if count < minimum: return "ok"  # nothing to do, adding a star can't unaward
+        return await self.settle(count, minimum, sb_id, timeout_d, msg_id, msg_ch_id, guild_id, msg)
 
     async def remove_star(self, minimum:int, sb_id:int, timeout_d:int|None, msg_id:int, msg_ch_id:int, guild_id:int,
-                          author_id:int, user_id:int, medium:int, msg:discord.Message|None=None) -> str:
-        dlt = await self.db.execute("DELETE FROM stars WHERE starrer=? AND msg=? AND medium=?", (user_id,msg_id,medium))
+                          author_id:int, user_id:int, medium:int, msg:Snapshot|None=None) -> str:
+        dlt = await self.committer.execute("DELETE FROM stars WHERE starrer=? AND msg=? AND medium=?",
+                                           (user_id,msg_id,medium))
         if dlt.rowcount == 0:
             # don't continue if the star wasn't recorded or in a different medium.
             # the error message isn't used if this is called from a reaction_remove, but it's cheap and pretty unlikely
             # (something has to get out of sync with the reactions)
-            match await self.db_fetchone("SELECT medium FROM stars WHERE starrer=? AND msg=?", (user_id,msg_id)):
+            match (await self.db_fetchone("SELECT medium FROM stars WHERE starrer=? AND msg=?", (user_id,msg_id))
+                   or await self.unpack_star(user_id, msg_id, medium)):
                 case None: return "you haven't starred that yet, bozo!"
                 case 0,:   return "you already reacted with a ⭐ to this message. remove this reaction to proceed."
                 case 1,:   return ("you already reacted with a ⭐ to the message in the starboard. remove this reaction"
                                    " to proceed.")
-        count, = await self.db_fetchone("SELECT count(*) FROM stars WHERE msg=?", (msg_id,))
+        return await self.settle(await self.star_count(msg_id), minimum, sb_id, timeout_d, msg_id, msg_ch_id, guild_id,
+                                 msg)
+
+    # remove_star for packed stars. True if it was removed, or (medium,) if it's there in another medium
+    async def unpack_star(self, user_id:int, msg_id:int, medium:int) -> bool|tuple[int]|None:
+        match await self.db_fetchone("SELECT starrers,mediums FROM packed WHERE msg=?", (msg_id,)):
+            case None: return None
+            case starrers, mediums: stars = unpack(starrers, mediums)
+        match stars.pop(user_id, None):
+            case None:              return None
+            case m if m != medium:  return m,
+        if stars: await self.committer.execute("UPDATE packed SET starrers=?,mediums=? WHERE msg=?",
+                                               (*pack(stars), msg_id))
+        else:     await self.committer.execute("DELETE FROM packed WHERE msg=?", (msg_id,))
+        return True
+
+    # puts the message in the starboard, takes it out, or edits it, according to its star count now. for after its
+    #   stars changed (with the message locked). the stars are committed before fetching or sending, and awarded is
+    #   written after the send
+    async def settle(self, count:int, minimum:int, sb_id:int, timeout_d:int|None, msg_id:int, msg_ch_id:int,
+                     guild_id:int, msg:Snapshot|None=None) -> str:
         if count<minimum and on_time(msg_id,timeout_d):  # message unawarded, or it wasn't awarded to begin with
             await self.unaward(msg_id, sb_id)
-        else:  # unstarred, but the message can stay in starboard
-            msg = msg or await self.fetch_msg_opt(msg_ch_id,msg_id)
-            if msg is None: return True
-            match await self.db_fetchone("SELECT msg_sb FROM awarded WHERE msg=?", (msg_id,)):
-                case msg_sb_id,:
-                    try: await self.partial_msg(sb_id,msg_sb_id).edit(**await self.build_message(count, msg))
-                    except discord.Forbidden: pass  # if the message was deleted, or on migration
-                case None if on_time(msg_id,timeout_d):
-                    # edge case: the message was and still is award-worthy, but it wasn't sent (maybe because minimum
-                    # was higher), and the timeout hasn't passed. we add it anyways, to be consistent with star add
-                    msg_sb = await self.bot.get_partial_messageable(sb_id).send(**await self.build_message(count, msg))
-                    await self.db.execute("INSERT INTO awarded(msg,msg_sb,msg_ch,guild,author) VALUES(?,?,?,?,?)",
-                                          (msg_id, msg_sb.id, msg_ch_id, guild_id, msg.author.id))
-        await self.db.commit()
+            return "ok"
+        match await self.db_fetchone("SELECT msg_sb FROM awarded WHERE msg=?", (msg_id,)):
+            case msg_sb_id,:  # already in starboard, edit the message (eventually)
+                if (msg := msg or await self.fetch_msg_opt(msg_ch_id,msg_id,commit=True)) is None:
+                    return "this message never existed. no clue what you are talking about"
+                self.edits.schedule(sb_id, msg_sb_id, count, msg)
+            case None if count>=minimum and on_time(msg_id,timeout_d):
+                # not in starboard yet. usually bc count==minimum, but maybe minimum was higher back then, and this is
+                #   an unstar or a catch-up (see `reconcile`)
+                await self.committer.commit(now=True)  # there's the send, and maybe a fetch
+                if (msg := msg or await self.fetch_msg_opt(msg_ch_id,msg_id)) is None:
+                    return "this message never existed. no clue what you are talking about"
+                msg_sb = await self.send_sb(sb_id, count, msg)
+                self.track(msg_id, msg_sb.id)
+                await self.committer.execute(
+                    "INSERT INTO awarded(msg,msg_sb,msg_ch,guild,author) VALUES(?,?,?,?,?)",
+                    (msg_id, msg_sb.id, msg_ch_id, guild_id, msg.author_id))
         return "ok"
 
     @commands.Cog.listener()
     async def on_raw_message_delete(self, ev:discord.RawMessageDeleteEvent):
-        await self.forget_message(ev.message_id)
+        self.messages.pop(ev.message_id)
+        if ev.message_id not in self.tracked: return  # never starred, so nothing to forget
+        async with self.locks(ev.message_id):
+            await self.forget_message(ev.message_id)
+            self.rerank(ev.guild_id)
+        await self.committer.commit()
 
     @commands.Cog.listener()
     async def on_raw_bulk_message_delete(self, ev:discord.RawBulkMessageDeleteEvent):
-        r = await self.get_guild_info(ev.guild_id)
-        for msg_id in ev.message_ids:
-            await self.forget_message(msg_id, r["sb_id"])
+        # like `forget_message` for all of them at once: one query each for stars and awarded, and one bulk delete for
+        #   their starboard messages
+        for msg_id in ev.message_ids: self.messages.pop(msg_id)
+        msg_ids = sorted(x for x in ev.message_ids if x in self.tracked)
+        if not msg_ids: return
+        params = ",".join("?"*len(msg_ids))
+        async with contextlib.AsyncExitStack() as stack:
+            for msg_id in msg_ids: await stack.enter_async_context(self.locks(msg_id))
+            async with self.committer.lock:
+                await self.db.execute(f"DELETE FROM stars WHERE msg IN ({params})", msg_ids)
+                await self.db.execute(f"DELETE FROM packed WHERE msg IN ({params})", msg_ids)
+                msg_sb_ids = [msg_sb_id for msg_sb_id, in await self.db.execute_fetchall(
+                              f"SELECT msg_sb FROM awarded WHERE msg IN ({params})", msg_ids)]
+                await self.db.execute(f"DELETE FROM awarded WHERE msg IN ({params})", msg_ids)
+            for msg_sb_id in msg_sb_ids:
+                self.edits.cancel(msg_sb_id)
+                self.rendered.pop(msg_sb_id)
+            self.rerank(ev.guild_id)
+        await self.committer.commit()
+        if msg_sb_ids and (config := self.guilds.get(ev.guild_id)) is not None:
+            _, sb_id, _ = config
+            await self.delete_sb(sb_id, msg_sb_ids)
+
+    # edits show up in the starboard right away. the edit event doesn't always have the whole message, so we fetch it
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, ev:discord.RawMessageUpdateEvent):
+        self.messages.pop(ev.message_id)
+        if ev.message_id not in self.tracked or ev.guild_id not in self.guilds: return
+        _, sb_id, _ = self.guilds[ev.guild_id]
+        async with self.locks(ev.message_id):
+            match await self.db_fetchone("SELECT msg_sb FROM awarded WHERE msg=?", (ev.message_id,)):
+                case msg_sb_id,:
+                    self.rerank(ev.guild_id, content=True)
+                    if (msg := await self.fetch_msg_opt(ev.channel_id, ev.message_id)) is not None:
+                        self.edits.schedule(sb_id, msg_sb_id, await self.star_count(ev.message_id), msg)
+        await self.committer.commit()  # in case the message was gone after all
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before:discord.abc.GuildChannel, after:discord.abc.GuildChannel):
+        self.forget_channel(after.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, ch:discord.abc.GuildChannel):
+        self.forget_channel(ch.id)
+
+    @commands.Cog.listener()
+    async def on_thread_update(self, before:discord.Thread, after:discord.Thread):
+        self.forget_channel(after.id)
+
+    @commands.Cog.listener()
+    async def on_raw_thread_delete(self, ev:discord.RawThreadDeleteEvent):
+        self.forget_channel(ev.thread_id)
+
+    ### CATCHING UP
+    # reactions added or removed while we're offline are never sent to us (after a resume discord sends them, but after
+    #   a new login it doesn't). so on every on_ready, every channel's history is read back to RECONCILE_DAYS before the
+    #   watermark, and messages whose ⭐ count doesn't match the stars we have get their reactions compared one by one
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.connected = True
+        if self.watermarking is None: self.watermarking = asyncio.create_task(self.keep_watermarks())
+        if self.reconciling is None or self.reconciling.done():
+            self.reconciling = asyncio.create_task(self.reconcile())
+
+    @commands.Cog.listener()
+    async def on_resumed(self):
+        self.connected = True
+
+    @commands.Cog.listener()
+    async def on_disconnect(self):
+        self.connected = False
+
+    async def keep_watermarks(self) -> None:
+        while True:
+            await asyncio.sleep(WATERMARK_INTERVAL)
+            if not self.connected: continue  # if it's not a resume, this is where the next reconcile will start
+            seen = discord.utils.time_snowflake(discord.utils.utcnow())
+            await self.committer.executemany("INSERT OR REPLACE INTO watermarks(guild,seen) VALUES(?,?)",
+                                             [(guild_id, seen) for guild_id in self.reconciled & self.guilds.keys()])
+            await self.committer.commit()
+
+    async def reconcile(self) -> None:
+        self.reconciled = set()
+        watermarks = dict(await self.read_fetchall("SELECT guild,seen FROM watermarks", ()))
+        fetches = asyncio.Semaphore(RECONCILE_FETCHES)
+        for guild_id in list(self.guilds):
+            if not self.ours(guild_id): continue  # its watermark is another process' business
+            if guild_id in watermarks and (guild := self.bot.get_guild(guild_id)) is not None:
+                try:
+                    changed = await self.reconcile_guild(guild, watermarks[guild_id], fetches)
+                    logging.info("caught up with guild %d, %d messages changed", guild_id, changed)
+                except Exception:  # the watermark stays where it was, so the next on_ready tries again
+                    logging.exception("couldn't catch up with guild %d", guild_id)
+                    continue
+            self.reconciled.add(guild_id)
+
+    async def reconcile_guild(self, guild:discord.Guild, seen:int, fetches:asyncio.Semaphore) -> int:
+        if (config := self.guilds.get(guild.id)) is None: return 0
+        _, sb_id, _ = config
+        since = discord.utils.time_snowflake(
+            discord.utils.snowflake_time(seen) - datetime.timedelta(days=RECONCILE_DAYS))
+        # how many ⭐ reactions we think each message and its starboard message have. the messages come from counts and
+        #   awarded, and then only their stars are read (stars has no index by guild). on a read connection, so stars
+        #   keep being written meanwhile. whatever's found to differ is checked again with the lock, on the writer
+        async with self.reader() as db:
+            expected = {msg_id:(react, react_sb) for msg_id, react, react_sb in await db.execute_fetchall(
+                "SELECT msg, sum(medium=?), sum(medium=?) FROM stars WHERE msg IN (SELECT msg FROM counts "
+                "WHERE guild=?3 AND msg>=?4 UNION ALL SELECT msg FROM awarded WHERE guild=?3 AND msg_sb>=?4) "
+                "GROUP BY msg",
+                (FROM_REACT, FROM_REACT_SB, guild.id, since))}
+            originals = {msg_sb_id:msg_id for msg_sb_id, msg_id in await db.execute_fetchall(
+                "SELECT msg_sb,msg FROM awarded WHERE guild=? AND msg_sb>=?", (guild.id, since))}
+        # msg_id -> message, starboard message. either can be None if its reactions are fine
+        suspects: dict[int, list[discord.Message|None]] = {}
+
+        async def scan(ch:discord.abc.Messageable) -> None:
+            async with fetches:
+                async for msg in ch.history(limit=None, after=discord.Object(since)):
+                    stars = discord.utils.get(msg.reactions, emoji="⭐")
+                    count = stars.count if stars else 0
+                    if ch.id != sb_id and count != expected.get(msg.id, (0,0))[0]:
+                        suspects.setdefault(msg.id, [None,None])[0] = msg
+                    elif (msg_id := originals.get(msg.id)) is not None and count != expected.get(msg_id, (0,0))[1]:
+                        suspects.setdefault(msg_id, [None,None])[1] = msg
+
+        channels = [ch for ch in [*guild.text_channels, *guild.threads]
+                    if ch.permissions_for(guild.me).read_message_history
+                    and (ch.id == sb_id or await self.channel_allowed(guild.id, ch.id))]
+        await asyncio.gather(*map(scan, channels))
+        changed = await asyncio.gather(*(self.reconcile_msg(guild.id, msg_id, msg, msg_sb, fetches)
+                                         for msg_id, (msg, msg_sb) in suspects.items()))
+        return sum(changed)
+
+    # compares the ⭐ reactions of the message and/or its starboard message with the stars we have in those mediums.
+    #   True if anything changed
+    async def reconcile_msg(self, guild_id:int, msg_id:int, msg:discord.Message|None, msg_sb:discord.Message|None,
+                            fetches:asyncio.Semaphore) -> bool:
+        async with fetches, self.locks(msg_id):
+            # packed messages are past their timeout, so their stars don't matter that much. not worth unpacking
+            if await self.db_fetchone("SELECT 1 FROM packed WHERE msg=?", (msg_id,)): return False
+            match await self.db_fetchone("SELECT msg_ch,author FROM awarded WHERE msg=?", (msg_id,)):
+                case _ if msg is not None: msg_ch_id, author_id = msg.channel.id, msg.author.id
+                case msg_ch_id, author_id: pass
+                case None: return False  # unawarded while we were getting here
+            have = {starrer:medium for starrer, medium in await self.db.execute_fetchall(
+                "SELECT starrer,medium FROM stars WHERE msg=?", (msg_id,))}
+            add, remove = [], []
+            for medium, m in (FROM_REACT, msg), (FROM_REACT_SB, msg_sb):
+                if m is None: continue
+                stars = discord.utils.get(m.reactions, emoji="⭐")
+                reacted = {user.id async for user in stars.users()} - {author_id} if stars else set()
+                add += [(starrer, msg_id, guild_id, medium) for starrer in reacted if starrer not in have]
+                remove += [(starrer, msg_id, medium) for starrer, had in have.items()
+                           if had == medium and starrer not in reacted]
+                for starrer in reacted: have.setdefault(starrer, medium)  # so reacting to both doesn't count twice
+            if not add and not remove: return False
+            self.track(msg_id)
+            await self.committer.executemany(
+                "INSERT OR IGNORE INTO stars(starrer,msg,guild,medium) VALUES(?,?,?,?)", add)
+            await self.committer.executemany(
+                "DELETE FROM stars WHERE starrer=? AND msg=? AND medium=?", remove)
+            info = self.get_guild_info(guild_id)
+            await self.settle(await self.star_count(msg_id), info["minimum"], info["sb_id"], info["timeout_d"],
+                              msg_id, msg_ch_id, guild_id, msg and Snapshot.of(msg))
+            self.rerank(guild_id)
+        await self.committer.commit()
+        return True
+
+    ### PACKING
+    # once a message is past its guild's timeout its stars can't change whether it's awarded anymore, only its count.
+    #   so we don't need a row for each of them with indexes and all: they're moved to one row in packed, along with
+    #   any packed before. add_star and remove_star look there too
+
+    async def sweep(self) -> None:
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                logging.info("packed the stars of %d messages", await self.pack_timed_out())
+            except Exception:
+                logging.exception("couldn't pack stars")
+
+    async def pack_timed_out(self) -> int:
+        n = 0
+        for guild_id, (_, _, timeout_d) in list(self.guilds.items()):
+            if timeout_d is None or not self.ours(guild_id): continue
+            cutoff = discord.utils.time_snowflake(discord.utils.utcnow() - datetime.timedelta(days=timeout_d))
+            for msg_id, in await self.db.execute_fetchall(
+                    "SELECT msg FROM counts WHERE guild=? AND msg<? "
+                    "AND EXISTS(SELECT 1 FROM stars WHERE stars.msg=counts.msg)", (guild_id, cutoff)):
+                async with self.locks(msg_id):
+                    await self.pack_message(msg_id, guild_id)
+                n += 1
+                if n % SWEEP_BATCH == 0: await self.committer.commit()
+        await self.committer.commit()
+        return n
+
+    async def pack_message(self, msg_id:int, guild_id:int) -> None:
+        match await self.db_fetchone("SELECT starrers,mediums FROM packed WHERE msg=?", (msg_id,)):
+            case None:              stars = {}
+            case starrers, mediums: stars = unpack(starrers, mediums)
+        stars |= {starrer:medium for starrer, medium in
+                  await self.db.execute_fetchall("SELECT starrer,medium FROM stars WHERE msg=?", (msg_id,))}
+        await self.committer.execute("DELETE FROM stars WHERE msg=?", (msg_id,))
+        await self.committer.execute(
+            "INSERT INTO packed(msg,guild,starrers,mediums) VALUES(?,?,?,?) "
+            "ON CONFLICT(msg) DO UPDATE SET starrers=excluded.starrers, mediums=excluded.mediums",
+            (msg_id, guild_id, *pack(stars)))
 
     ### USER COMMANDS
 
     @commands.hybrid_command()
     async def info(self, ctx:commands.Context):
         """see some server-specific statistics for starboard."""
-        total_stars,starred_messages = await self.db_fetchone(
-            "SELECT count(*),count(DISTINCT msg) FROM stars WHERE guild=?", (ctx.guild.id,))
+        total_stars,starred_messages,awarded_messages = await self.read_fetchone(
+            "SELECT coalesce(sum(count),0),count(*),"
+            "(SELECT coalesce(sum(n),0) FROM sizes WHERE guild=?1 AND author=0) FROM counts WHERE guild=?1",
+            (ctx.guild.id,))
         txt = f"Hi, i am asteroid ^_^\nI have seen {total_stars} stars and {starred_messages} starred messages.\n"
-        match await self.db_fetchone("SELECT minimum,sb FROM guilds WHERE guild=?", (ctx.guild.id,)):
-            case minimum,sb_id:
-                awarded_messages,= await self.db_fetchone("SELECT count(*) FROM awarded WHERE guild=?", (ctx.guild.id,))
+        match self.guilds.get(ctx.guild.id):
+            case minimum,sb_id,_:
                 txt += (f"When messages reach {minimum} ⭐, they will be resent to <#{sb_id}>. "
                         f"Right now there are {awarded_messages} messages there.")
             case None:
@@ -291,39 +1203,81 @@ class Starboard(commands.Cog):
         await ctx.send(txt)
 
     @commands.hybrid_command()
-    async def top(self, ctx:commands.Context):
-        """see the top starred messages in the current guild."""
-        async with ctx.typing():
-            messages = await asyncio.gather(*[self.fetch_msg_opt(msg_ch_id,msg_id) async for msg_ch_id,msg_id in
-                await self.db.execute("SELECT msg_ch,msg FROM awarded WHERE guild=? "
-                                      "ORDER BY (SELECT count(*) FROM stars WHERE msg=awarded.msg) DESC "
-                                      "LIMIT 10", (ctx.guild.id,))])
+    async def top(self, ctx:commands.Context, page:commands.Range[int,1]|None=None,
+                  window:Literal["week","month","all"]="all", user:discord.User|None=None):
+        """see the top starred messages in the current guild.
+
+        :param page: which page to show, 10 messages each (the first if not given)
+        :param window: only messages from the last week or month, or all time (the default)
+        :param user: optional. filter posts from a certain user"""
+        # a cached page is shown as is if no stars changed since. otherwise the ranking is read again (it's an index
+        #   walk, see idx_counts), and if the page has the same messages it's still not rendered again. the window is
+        #   +counts.msg, so it can't be used as an index: with one guild in the db, guild=? looks no better than it
+        #   and the planner would rather take msg>=? from awarded's rowid, and then sort
+        page = page or 1  # optional, so `*top week` works as a text command
+        key = ctx.guild.id, window, user and user.id, page
+        version = self.ranking.get(ctx.guild.id, 0)
+        match self.pages.get(key):
+            case v, _, embed if v == version:
+                return await ctx.send(allowed_mentions=discord.AllowedMentions.none(), embed=embed)
+            case _, cached_rows, embed: pass
+            case None: cached_rows = None
+        since = 0 if (days := WINDOWS[window]) is None else \
+            discord.utils.time_snowflake(discord.utils.utcnow() - datetime.timedelta(days=days))
+        rows = await self.read_fetchall(
+            "SELECT msg_ch,msg FROM counts JOIN awarded USING(msg) WHERE counts.guild=? AND +counts.msg>=?"
+            + " AND awarded.guild=counts.guild AND author=?"*(user is not None)
+            + " ORDER BY count DESC, msg DESC LIMIT ? OFFSET ?",
+            (ctx.guild.id, since, *([] if user is None else [user.id]), TOP_PAGE, (page-1)*TOP_PAGE))
+        if rows != cached_rows:
+            async with ctx.typing():
+                messages = await asyncio.gather(*[self.show_msg_opt(msg_ch_id,msg_id) for msg_ch_id,msg_id in rows])
             def shorten(x:str) -> str: return x[:400] + (x[400:] and "…")
-            await ctx.send(allowed_mentions=discord.AllowedMentions.none(),embed=discord.Embed(
-                title="Top Messages in Starboard",
+            embed = discord.Embed(
+                title="Top Messages in Starboard" + {"week":" this week", "month":" this month", "all":""}[window]
+                    + ("" if user is None else f" by {user.display_name}"),
                 colour=discord.Colour.from_rgb(255,255,127),
                 description="\n".join(
-                    shorten(f"1. {msg.jump_url} **{msg.author.display_name}**: " + short_disp(msg, escape=True))
-                for msg in messages if msg),
-            ))
+                    shorten(f"{i}. {msg.jump_url} **{msg.author_name}**: " + short_disp(msg, escape=True))
+                for i, msg in enumerate(messages, (page-1)*TOP_PAGE+1) if msg) or "nothing here",
+            ).set_footer(text=f"page {page}")
+            if None in messages:  # some are gone, and have been forgotten. don't keep the page
+                return await ctx.send(allowed_mentions=discord.AllowedMentions.none(), embed=embed)
+        self.pages[key] = version, rows, embed
+        await ctx.send(allowed_mentions=discord.AllowedMentions.none(), embed=embed)
 
     @commands.hybrid_command()
     async def random(self, ctx:commands.Context, user:discord.User|None=None):
         """see a random starred message
 
         :param user: optional. filter posts from a certain user"""
-        if user is None:
-            out = await self.db_fetchone(
-                "SELECT msg,msg_ch FROM awarded WHERE guild=? ORDER BY random() LIMIT 1", (ctx.guild.id,))
-        else:
-            out = await self.db_fetchone(
-                "SELECT msg,msg_ch FROM awarded WHERE guild=? AND author=? ORDER BY random() LIMIT 1",
-                (ctx.guild.id, user.id))
-        match out:
+        match await self.random_awarded(ctx.guild.id, user and user.id):
             case None: await ctx.send("no starred messages :(")
-            case msg_id, msg_ch_id:
-                count, = await self.db_fetchone("SELECT count(*) FROM stars WHERE msg=?", (msg_id,))
-                await ctx.send(**await self.build_message(count, await self.fetch_msg(msg_ch_id,msg_id)))
+            case msg_id, msg_ch_id, count:
+                match await self.show_msg_opt(msg_ch_id,msg_id):
+                    case None: await ctx.send("that message is gone now. try again")
+                    case msg:  await ctx.send(**await self.build_message(count, msg))
+
+    # picks a number below the guild's (or the author's) count of awarded messages, and takes the message with it (and
+    #   its star count). see migration 4. tries again if the message is unawarded right in between. all on the same
+    #   read connection, given back before the message is fetched
+    async def random_awarded(self, guild_id:int, author_id:int|None=None) -> tuple[int,int,int]|None:
+        async with self.reader() as db:
+            for _ in range(3):
+                match await self.db_fetchone("SELECT n FROM sizes WHERE guild=? AND author=?",
+                                             (guild_id, author_id or 0), db):
+                    case None: return None
+                    case n,:   i = random.randrange(n)
+                if author_id is None:
+                    out = await self.db_fetchone("SELECT msg,msg_ch,coalesce(count,0) FROM awarded "
+                                                 "LEFT JOIN counts USING(msg) WHERE awarded.guild=? AND ord=?",
+                                                 (guild_id, i), db)
+                else:
+                    out = await self.db_fetchone("SELECT msg,msg_ch,coalesce(count,0) FROM awarded "
+                                                 "LEFT JOIN counts USING(msg) WHERE awarded.guild=? AND author=? "
+                                                 "AND author_ord=?", (guild_id, author_id, i), db)
+                if out is not None: return out
+        return None
 
     @commands.command(description="show a certain starred message")
     async def show(self, ctx:commands.Context, msg:discord.Message|None):
@@ -334,13 +1288,13 @@ class Starboard(commands.Cog):
         match msg, ctx.message.reference:
             case None, None: return await ctx.send("wdym")
             case None, ref:  msg = ref.resolved  # this COULD be deleted but realistically it won't
-        count, = await self.db_fetchone("SELECT count(*) FROM stars WHERE msg=?", (msg.id,))
-        await ctx.send(**await self.build_message(count, msg))
+        count = await self.star_count(msg.id, read=True)
+        await ctx.send(**await self.build_message(count, Snapshot.of(msg)))
 
     ### ADMIN COMMANDS
 
     async def printout(self, guild_id):  # brief output of all the settings if no args are given
-        match await self.db_fetchone("SELECT minimum,sb,timeout FROM guilds WHERE guild=?", (guild_id,)):
+        match self.guilds.get(guild_id):
             case minimum, sb_id, None:
                 msg = f"starboard channel: <#{sb_id}>\nminimum stars: {minimum}\ntimeout: never"
             case minimum, sb_id, timeout_d:
@@ -349,6 +1303,33 @@ class Starboard(commands.Cog):
                 msg = "unconfigured"
         return msg
 
+    async def load_guild(self, guild_id:int) -> None:  # call after commit/rollback, so the cache matches the db
+        match await self.db_fetchone("SELECT minimum,sb,timeout FROM guilds WHERE guild=?", (guild_id,)):
+            case None: self.guilds.pop(guild_id, None)
+            case row:  self.guilds[guild_id] = row
+
+    # starconfig gets the connection to itself, so a rollback only undoes its own changes
+    @contextlib.asynccontextmanager
+    async def config_transaction(self, guild_id:int):
+        async with self.committer.lock:
+            await self.db.commit()  # just in case, we don't want to rollback earlier stuff
+            try:
+                yield
+            except ValueError:
+                await self.db.rollback()
+                raise
+            else:
+                await self.db.commit()
+                self.peers.send({"guild":guild_id})
+            finally:
+                await self.load_guild(guild_id)
+
+    # another process changed a guild's config
+    @commands.Cog.listener()
+    async def on_peer_message(self, message:dict):
+        match message:
+            case {"guild": int(guild_id)}: await self.load_guild(guild_id)
+
     async def set_sb(self, sb: discord.TextChannel, guild_id: int) -> None:
         if sb.guild.id != guild_id: raise ValueError("eat bricks")
         await self.db.execute("INSERT OR REPLACE INTO guilds(sb,guild) VALUES(?,?)", (sb.id, guild_id))
@@ -377,18 +1358,16 @@ class Starboard(commands.Cog):
         :param timeout_d: timeout period in days. after this period, messages cannot be added to or removed
             from the starboard.
         """
-        await self.db.commit()  # just in case, we don't want to rollback earlier stuff
         if sb is None and minimum is None and timeout_d is None:
             return await c.response.send_message(await self.printout(c.guild_id))
         try:
-            if sb        is not None: await self.set_sb     (sb,        c.guild_id)
-            if minimum   is not None: await self.set_minimum(minimum,   c.guild_id)
-            if timeout_d is not None: await self.set_timeout(timeout_d, c.guild_id)
+            async with self.config_transaction(c.guild_id):
+                if sb        is not None: await self.set_sb     (sb,        c.guild_id)
+                if minimum   is not None: await self.set_minimum(minimum,   c.guild_id)
+                if timeout_d is not None: await self.set_timeout(timeout_d, c.guild_id)
         except ValueError as e:
-            await self.db.rollback()
             return await c.response.send_message(e.args[0])
 
-        await self.db.commit()
         await c.response.send_message("ok. new settings:\n" + await self.printout(c.guild_id))
 
     @commands.command()
@@ -405,77 +1384,220 @@ class Starboard(commands.Cog):
         minimum: the minimum star count to reach starboard.
         timeout: timeout period in days. after this period, messages cannot be added to or removed from the starboard.
         """
-        await self.db.commit()  # just in case, we don't want to rollback earlier stuff
         args = [*args]
         if len(args) == 0:
             return await ctx.send(await self.printout(ctx.guild.id))
         try:
-            while len(args) > 0:
-                match args.pop(0):
-                    case "sb" | "starboard" | "starboard-channel":
-                        try:
-                            sb = await commands.TextChannelConverter().convert(ctx, args.pop(0))
-                        except commands.BadArgument: raise ValueError("not a channel")
-                        await self.set_sb(sb, ctx.guild.id)
-                    case "minimum": await self.set_minimum(int(args.pop(0)), ctx.guild.id)
-                    case "timeout": await self.set_timeout(int(args.pop(0)), ctx.guild.id)
-                    case x: raise ValueError("what is a "+x)
+            async with self.config_transaction(ctx.guild.id):
+                while len(args) > 0:
+                    match args.pop(0):
+                        case "sb" | "starboard" | "starboard-channel":
+                            try:
+                                sb = await commands.TextChannelConverter().convert(ctx, args.pop(0))
+                            except commands.BadArgument: raise ValueError("not a channel")
+                            await self.set_sb(sb, ctx.guild.id)
+                        case "minimum": await self.set_minimum(int(args.pop(0)), ctx.guild.id)
+                        case "timeout": await self.set_timeout(int(args.pop(0)), ctx.guild.id)
+                        case x: raise ValueError("what is a "+x)
         except ValueError as e:  # also triggered by the int() conversions
-            await self.db.rollback()
             return await ctx.send(e.args[0])
-        await self.db.commit()
         await ctx.send("ok. new settings:\n" + await self.printout(ctx.guild.id))
 
     @commands.command()
     @commands.check_any(commands.has_permissions(manage_channels=True), commands.is_owner())
     async def import_rdanny(self, ctx:commands.Context, sb:discord.TextChannel):
-        """imports messages from an R. Danny starboard channel.
+        """imports messages from an R. Danny starboard channel. if it stops halfway through, running it again picks up
+        where it left off.
         :param sb: the starboard channel in question
         """
-        scanned = 0
+        # the history is read oldest first, IMPORT_CHUNK messages at a time. the originals and their starrers for a
+        #   chunk are fetched all at once (IMPORT_FETCHES requests at a time), while the history goes on to the next
+        #   one. then everything in the chunk is written, along with the checkpoint (the last message in it). the
+        #   inserts are all OR IGNORE, so a chunk that was half written before a crash is just written again
+        match await self.db_fetchone("SELECT last,scanned FROM imports WHERE sb=?", (sb.id,)):
+            case None:          last, scanned = None, 0
+            case last, scanned: pass
         mismatches: list[discord.Message] = []
         unparsable: list[discord.Message] = []
         unfindable: list[discord.Message] = []
-        async for msg_sb in sb.history(limit=None):
-            if msg_sb.author.id != 80528701850124288: continue
+        fetches = asyncio.Semaphore(IMPORT_FETCHES)
+        status = await ctx.send(f"importing... (picking up after {scanned} messages)" if scanned else "importing...")
+        shown = time.monotonic()
+
+        async def starrers(msg:discord.Message, author_id:int) -> list[int]:
+            if (stars := discord.utils.get(msg.reactions, emoji="⭐")) is None: return []
+            async with fetches:
+                return [starrer.id async for starrer in stars.users() if starrer.id != author_id]  # cheeky self-star
+
+        async def fetch(msg_sb:discord.Message) -> tuple|None:
             if not (m := re.fullmatch(r".(?: \*\*(\d+)\*\*)? <#(\d+)> ID: (\d+)", msg_sb.content)):
                 unparsable.append(msg_sb)
-                continue
+                return None
             count, msg_ch_id, msg_id = int(m[1] or "1"), int(m[2]), int(m[3])
             try:
-                msg = await self.fetch_msg(msg_ch_id,msg_id)
+                async with fetches:
+                    msg = await self.fetch_msg(msg_ch_id,msg_id)
             except (discord.NotFound, discord.Forbidden):
                 unfindable.append(msg_sb)
-                continue
-            changes_before = self.db.total_changes
-            # get original stars
-            if (stars := discord.utils.get(msg.reactions, emoji="⭐")):
-                async for starrer in stars.users():
-                    if starrer.id == msg.author.id: continue  # cheeky self-star
-                    await self.db.execute("INSERT OR IGNORE INTO stars(starrer,msg,guild,medium) VALUES(?,?,?,?)",
-                        (starrer.id, msg_id, ctx.guild.id, FROM_REACT))
-            # get msg_sb stars
-            if (stars := discord.utils.get(msg_sb.reactions, emoji="⭐")):
-                async for starrer in stars.users():
-                    if starrer == msg.author.id: continue
-                    await self.db.execute("INSERT OR IGNORE INTO stars(starrer,msg,guild,medium) VALUES(?,?,?,?)",
-                        (starrer.id, msg_id, ctx.guild.id, FROM_REACT_SB))
-            changes_after = self.db.total_changes
+                return None
+            # original stars, then msg_sb stars
+            stars = await asyncio.gather(starrers(msg, msg.author.id), starrers(msg_sb, msg.author.id))
+            return msg_sb, count, msg_ch_id, msg_id, msg.author.id, stars
+
+        async def write(chunk:list[discord.Message]) -> None:
+            nonlocal scanned, shown
+            posts = [msg_sb for msg_sb in chunk if msg_sb.author.id == RDANNY]
+            found = [x for x in await asyncio.gather(*map(fetch, posts)) if x is not None]
+            self.track(*(msg_id for _, _, _, msg_id, _, _ in found))
+            await self.committer.executemany(
+                "INSERT OR IGNORE INTO stars(starrer,msg,guild,medium) VALUES(?,?,?,?)",
+                [(starrer, msg_id, ctx.guild.id, medium) for _, _, _, msg_id, _, stars in found
+                 for medium, ids in zip((FROM_REACT, FROM_REACT_SB), stars) for starrer in ids])
+            # stars of messages that are packed already go in with the others, or they'd count twice (like *importdump)
+            for msg_id, in await self.db.execute_fetchall(
+                    f"SELECT msg FROM packed WHERE msg IN ({','.join('?'*len(found))})", [x[3] for x in found]):
+                async with self.locks(msg_id):
+                    await self.pack_message(msg_id, ctx.guild.id)
+            self.track(*(msg_sb.id for msg_sb, *_ in found))
+            await self.committer.executemany(
+                "INSERT OR IGNORE INTO awarded(msg,msg_sb,msg_ch,guild,author) VALUES(?,?,?,?,?)",
+                [(msg_id, msg_sb.id, msg_ch_id, ctx.guild.id, author_id)
+                 for msg_sb, _, msg_ch_id, msg_id, author_id, _ in found])
+            scanned += len(found)
+            await self.committer.execute("INSERT OR REPLACE INTO imports(sb,guild,last,scanned) VALUES(?,?,?,?)",
+                                         (sb.id, ctx.guild.id, chunk[-1].id, scanned))
+            self.rerank(ctx.guild.id)
+            await self.committer.commit()
             # ignore stars added by command (hopefully no one did that)
-            count_computed, = await self.db_fetchone("SELECT count(*) FROM stars WHERE msg=?", (msg_id,))
-            if count != count_computed: mismatches.append(msg_sb)
-            logging.warn(f"{count=}, {count_computed=}, {changes_after - changes_before=}")
-            # add awarded
-            await self.db.execute("INSERT OR IGNORE INTO awarded(msg,msg_sb,msg_ch,guild,author) VALUES(?,?,?,?,?)",
-                                  (msg_id, msg_sb.id, msg_ch_id, ctx.guild.id, msg.author.id))
-            scanned += 1
-        await self.db.commit()
+            counts = {msg_id:count for msg_id,count in await self.db.execute_fetchall(
+                f"SELECT msg,count FROM counts WHERE msg IN ({','.join('?'*len(found))})", [x[3] for x in found])}
+            mismatches.extend(msg_sb for msg_sb, count, _, msg_id, _, _ in found if counts.get(msg_id, 0) != count)
+            if time.monotonic() - shown > IMPORT_PROGRESS:
+                shown = time.monotonic()
+                await status.edit(content=f"importing... {scanned} messages so far, up to {chunk[-1].jump_url}")
+
+        chunk: list[discord.Message] = []
+        writing: asyncio.Task|None = None
+        try:
+            async for msg_sb in sb.history(limit=None, oldest_first=True, after=last and discord.Object(last)):
+                chunk.append(msg_sb)
+                if len(chunk) == IMPORT_CHUNK:
+                    if writing: await writing  # one at a time, so the checkpoints go in order
+                    writing, chunk = asyncio.create_task(write(chunk)), []
+        finally:  # if reading the history fails, at least keep what we have
+            if writing: await writing
+        if chunk: await write(chunk)
+        await status.edit(content=f"imported {scanned} messages")
         await ctx.send(f"{scanned} messages added" +
             "\nstar count mismatches: "       *(len(mismatches)!=0) + ", ".join(i.jump_url for i in mismatches) +
             "\nmessages i didn't understand: "*(len(unparsable)!=0) + ", ".join(i.jump_url for i in unparsable) +
             "\nmessages i didn't find: "      *(len(unfindable)!=0) + ", ".join(i.jump_url for i in unfindable) +
             "\nnow you need to unconfigure r.danny and configure asteroid, i think")
 
+    @commands.command()
+    @commands.check_any(commands.has_permissions(manage_channels=True), commands.is_owner())
+    async def export(self, ctx:commands.Context, fmt:Literal["jsonl","csv"]="jsonl"):
+        """uploads everything starred in this server (every star and every starboard message) as gzipped jsonl or csv.
+        if it's too big for one upload it's split into parts. *importdump reads it back
+        :param fmt: jsonl or csv
+        """
+        # the rows go from a read connection to the file DUMP_CHUNK at a time, and each part is uploaded and closed as
+        #   soon as it's full, so this doesn't take more memory with bigger servers. it's all in one read transaction,
+        #   so the dump is one moment of the db even while stars keep coming
+        guild_id = ctx.guild.id
+        writer = DumpWriter(fmt, ctx.guild.filesize_limit)
+        parts = rows = 0
+        async def upload(part:tempfile.SpooledTemporaryFile|None) -> None:
+            nonlocal parts
+            if part is None: return
+            parts += 1
+            with part:
+                await ctx.send(f"part {parts}", file=discord.File(
+                    part, filename=f"asteroid-{guild_id}-{datetime.date.today().isoformat()}-{parts}.{fmt}.gz"))
+        async with ctx.typing(), self.reader() as db:
+            await db.execute("BEGIN")
+            try:
+                # packed stars are stars like any other in the dump. stars and packed have no index by guild, so the
+                #   guild's messages come from counts (every message with stars, packed or not), and then their stars
+                #   by msg. CROSS JOIN keeps sqlite from doing it the other way around
+                for table, packed, sql in [
+                        ("awarded", False, "SELECT msg,msg_sb,msg_ch,guild,author FROM awarded WHERE guild=?"),
+                        ("stars",   False, "SELECT starrer,msg,stars.guild,medium FROM counts CROSS JOIN stars "
+                                           "USING(msg) WHERE counts.guild=?1 AND stars.guild=?1"),
+                        ("stars",   True,  "SELECT msg,packed.guild,starrers,mediums FROM counts CROSS JOIN packed "
+                                           "USING(msg) WHERE counts.guild=?1 AND packed.guild=?1")]:
+                    cur = await db.execute(sql, (guild_id,))
+                    while chunk := await cur.fetchmany(DUMP_CHUNK):
+                        if packed:
+                            chunk = [(starrer, msg_id, g, medium) for msg_id, g, starrers, mediums in chunk
+                                     for starrer, medium in unpack(starrers, mediums).items()]
+                        rows += len(chunk)
+                        for part in await asyncio.to_thread(writer.write, table, chunk): await upload(part)
+            finally:
+                await db.execute("COMMIT")
+            await upload(await asyncio.to_thread(writer.close))
+        await ctx.send(f"{rows} rows in {parts} parts" if parts else "nothing starred here yet")
+
+    @commands.command()
+    @commands.check_any(commands.has_permissions(manage_channels=True), commands.is_owner())
+    async def importdump(self, ctx:commands.Context):
+        """loads a dump made by *export. attach all of its parts to the message (or do it in several goes, in any
+        order). stars and starboard messages that are already here are left as they are, and rows from other servers
+        (or for messages that are another server's here) are skipped
+        """
+        if not ctx.message.attachments: return await ctx.send("attach the dump, bozo")
+        guild_id = ctx.guild.id
+        rows = skipped = 0
+        async def write(chunk:list[tuple[str,tuple]]) -> None:
+            nonlocal rows, skipped
+            mine = [(table, row) for table, row in chunk if row[DUMP_COLUMNS[table].index("guild")] == guild_id]
+            # a message we have under another server isn't this one's, whatever the dump says. its stars would go to
+            #   the other server's count (counts only knows the msg), and an awarded row would keep it out of that
+            #   server's starboard
+            ids = sorted({row[DUMP_COLUMNS[table].index("msg")] for table, row in mine})
+            params = ",".join(f"?{i}" for i in range(2, len(ids)+2))
+            elsewhere = {msg_id for msg_id, in await self.db.execute_fetchall(
+                f"SELECT msg FROM counts WHERE msg IN ({params}) AND guild!=?1 UNION ALL "
+                f"SELECT msg FROM awarded WHERE msg IN ({params}) AND guild!=?1 UNION ALL "
+                f"SELECT msg FROM packed WHERE msg IN ({params}) AND guild!=?1", (guild_id, *ids))} if ids else set()
+            mine = [(table, row) for table, row in mine if row[DUMP_COLUMNS[table].index("msg")] not in elsewhere]
+            skipped += len(chunk) - len(mine)
+            rows += len(mine)
+            awarded = [row for table, row in mine if table == "awarded"]
+            stars = [row for table, row in mine if table == "stars"]
+            msg_ids = sorted({msg_id for _, msg_id, *_ in stars})
+            self.track(*(x for msg_id, msg_sb_id, *_ in awarded for x in (msg_id, msg_sb_id)))
+            await self.committer.executemany(
+                "INSERT OR IGNORE INTO awarded(msg,msg_sb,msg_ch,guild,author) VALUES(?,?,?,?,?)", awarded)
+            self.track(*msg_ids)
+            await self.committer.executemany(
+                "INSERT OR IGNORE INTO stars(starrer,msg,guild,medium) VALUES(?,?,?,?)", stars)
+            # stars of messages that are packed already go in with the others, or they'd count twice
+            for msg_id, in await self.db.execute_fetchall(
+                    f"SELECT msg FROM packed WHERE msg IN ({','.join('?'*len(msg_ids))})", msg_ids):
+                async with self.locks(msg_id):
+                    await self.pack_message(msg_id, guild_id)
+            self.rerank(guild_id)
+            await self.committer.commit(now=True)
+        async with ctx.typing():
+            for attachment in ctx.message.attachments:
+                match attachment.filename.rsplit(".", 2)[1:]:
+                    case ["jsonl" | "csv" as fmt, "gz"]: pass
+                    case _: return await ctx.send(f"{attachment.filename} isn't a .jsonl.gz or .csv.gz, bozo")
+                # a part is never bigger than the upload limit, so it's fine to have it in memory. what's in it isn't
+                records = read_dump(io.BytesIO(await attachment.read()), fmt)
+                writing: asyncio.Task|None = None
+                try:
+                    try:  # the next chunk is read while the last one is written
+                        while chunk := await asyncio.to_thread(list, itertools.islice(records, DUMP_BATCH)):
+                            if writing: await writing
+                            writing = asyncio.create_task(write(chunk))
+                    finally:
+                        if writing: await writing
+                except ValueError as e:
+                    return await ctx.send(f"{attachment.filename} is broken ({e}). {rows} rows loaded before that")
+        await ctx.send(f"{rows} rows loaded" + f", {skipped} from other servers skipped"*(skipped != 0))
+
     ### ERRORS
 
     @commands.Cog.listener()
@@ -489,7 +1611,7 @@ class Starboard(commands.Cog):
             logging.exception(":(", exc_info=exc)
 
 async def setup(bot):
-    await bot.db.executescript(SCHEMA)
+    await database.migrate(bot.db, MIGRATIONS)
     await bot.add_cog(Starboard(bot))
 
 if __name__ == "__main__": print("you ran the wrong file. BOZO")